@@ -0,0 +1,81 @@
+"""
+Compares the FrameDecoder with the previous ThreadedClient.get_complete_message
+on a stream of newline delimited messages.
+
+    python -m benchmarks.bench_framing
+"""
+import timeit
+
+from classes.framing import FrameDecoder
+
+
+class ChunkedSocket():
+    """
+    Stand-in for a socket returning a stream in fixed size chunks.
+    """
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.position = 0
+
+    def recv(self, size):
+        size = min(size, self.chunk_size)
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer):
+        chunk = self.recv(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def get_complete_message(sock):
+    # previous implementation, it drops the bytes after the first delimiter
+    more_data = True
+    message_buffer = b''
+    while more_data:
+        data = sock.recv(8192)
+        if not data:
+            break
+        if '\n'.encode('ascii') in data:
+            more_data = False
+            message_buffer += data.strip('\n'.encode('ascii'))
+        else:
+            message_buffer += data
+    return message_buffer
+
+
+def run_previous(data, chunk_size):
+    sock = ChunkedSocket(data, chunk_size)
+    messages = []
+    while sock.position < len(data):
+        messages.append(get_complete_message(sock))
+    return messages
+
+
+def run_decoder(data, chunk_size):
+    sock = ChunkedSocket(data, chunk_size)
+    decoder = FrameDecoder()
+    messages = []
+    while decoder.recv_into(sock):
+        messages.extend(decoder.frames())
+    return messages
+
+
+def main():
+    cases = [
+        ('small messages', b''.join(b'side %d\n' % (i % 8) for i in range(20000)), 8192),
+        ('large messages', (b'x' * 1000000 + b'\n') * 4, 8192),
+    ]
+    for name, data, chunk_size in cases:
+        expected = data.count(b'\n')
+        for label, function in (('previous', run_previous), ('decoder', run_decoder)):
+            messages = function(data, chunk_size)
+            seconds = min(timeit.repeat(lambda: function(data, chunk_size), number=1, repeat=5))
+            print('%-15s %-9s %8.2f ms  %6d/%d frames' % (
+                name, label, seconds * 1000, len(messages), expected))
+
+
+if __name__ == '__main__':
+    main()
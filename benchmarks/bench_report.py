@@ -0,0 +1,89 @@
+"""
+Local report engine on synthetic history: years of entries of many users,
+compared with aggregating the same entries in plain Python. The /report
+API path adds a network round trip and the server time to every view on
+top of that, it can't be timed offline.
+
+    python -m benchmarks.bench_report [--users 20] [--years 3]
+"""
+import argparse
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from classes.report import ReportEngine
+from classes.timeular import format_time, parse_time
+
+
+def synthetic_entries(users, years, per_day=8):
+    random.seed(1)
+    entries = []
+    start = datetime(2020, 1, 1)
+    for user in range(users):
+        moment = start
+        end = start + timedelta(days=365 * years)
+        while moment < end:
+            duration = timedelta(minutes=random.randint(5, 180))
+            entries.append({
+                "id": str(len(entries)),
+                "activity": {"id": str(user * 10 + random.randint(0, 9))},
+                "duration": {"startedAt": format_time(moment),
+                             "stoppedAt": format_time(moment + duration)},
+                "note": {"tags": [{"key": str(random.randint(0, 50)), "indices": [0, 1]}],
+                         "mentions": []}})
+            moment += duration + timedelta(minutes=random.randint(0, 24 * 60 // per_day))
+    return entries
+
+
+def python_by_day(entries, timezone):
+    # per entry reference implementation, on epochs: aware datetimes of the
+    # same zone compare and subtract as wall times, which is wrong across DST
+    totals = defaultdict(lambda: defaultdict(float))
+    utc = ZoneInfo('UTC')
+    for entry in entries:
+        start = parse_time(entry["duration"]["startedAt"]).replace(tzinfo=utc).timestamp()
+        stop = parse_time(entry["duration"]["stoppedAt"]).replace(tzinfo=utc).timestamp()
+        while start < stop:
+            local = datetime.fromtimestamp(start, timezone)
+            midnight = (datetime(local.year, local.month, local.day, tzinfo=timezone) +
+                        timedelta(days=1)).timestamp()
+            piece_stop = min(stop, midnight)
+            totals[local.date()][entry["activity"]["id"]] += piece_stop - start
+            start = piece_stop
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--years', type=int, default=3)
+    args = parser.parse_args()
+
+    entries = synthetic_entries(args.users, args.years)
+    print('%d entries' % len(entries))
+
+    began = time.perf_counter()
+    engine = ReportEngine(entries)
+    loaded = time.perf_counter()
+    engine.by_activity()
+    engine.by_tag()
+    by_day = engine.by_day()
+    engine.by_week()
+    done = time.perf_counter()
+    print('engine   load %7.1f ms  activity+tag+day+week %7.1f ms' % (
+        (loaded - began) * 1000, (done - loaded) * 1000))
+
+    began = time.perf_counter()
+    reference = python_by_day(entries, engine.timezone)
+    print('python   day %7.1f ms' % ((time.perf_counter() - began) * 1000))
+
+    mismatches = sum(1 for date, activities in reference.items()
+                     for activity_id, seconds in activities.items()
+                     if abs(by_day.get(date, {}).get(activity_id, 0) - seconds) > 1e-3)
+    print('mismatching day totals: %d' % mismatches)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Cold start of the GUI: time from process start to the first paint of the
+window and, with --connect, to the first BLE subscription of the tracker
+configured in data.json.
+
+    python -m benchmarks.bench_startup [--runs 5] [--connect]
+    python -m benchmarks.bench_startup --save      # record the baseline
+    python -m benchmarks.bench_startup --check 20  # fail if >20% slower
+
+The baseline is kept in benchmarks/startup_baseline.json.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'startup_baseline.json')
+
+
+def run_once(mode, timeout):
+    environment = dict(os.environ, TIMEULAR_STARTUP_BENCH=mode)
+    started = time.time()
+    process = subprocess.Popen([sys.executable, 'run.py'], cwd=ROOT, env=environment,
+                               stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                               universal_newlines=True)
+    milestones = {}
+    wanted = 'ble_subscribed' if mode == 'connect' else 'first_paint'
+    try:
+        for line in process.stderr:
+            if line.startswith('{"startup"'):
+                entry = json.loads(line)
+                milestones[entry['startup']] = entry['time'] - started
+                if entry['startup'] == wanted:
+                    break
+            if time.time() - started > timeout:
+                break
+    finally:
+        process.kill()
+        process.wait()
+    return milestones
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--connect', action='store_true',
+                        help='also measure the first BLE subscription')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--save', action='store_true', help='store the result as baseline')
+    parser.add_argument('--check', type=float, metavar='PERCENT',
+                        help='exit with 1 if a milestone regressed more than PERCENT')
+    args = parser.parse_args()
+
+    runs = [run_once('connect' if args.connect else 'paint', args.timeout)
+            for _ in range(args.runs)]
+    result = {}
+    for milestone in ('first_paint', 'ble_subscribed'):
+        times = [run[milestone] for run in runs if milestone in run]
+        if times:
+            result[milestone] = statistics.median(times)
+            print('%-15s median %7.1f ms  (%d/%d runs)' % (
+                milestone, result[milestone] * 1000, len(times), len(runs)))
+
+    if args.save:
+        with open(BASELINE, 'w') as outfile:
+            json.dump(result, outfile, indent=2)
+    if args.check is not None:
+        if not os.path.exists(BASELINE):
+            sys.exit('No baseline at %s, record one with --save' % BASELINE)
+        with open(BASELINE) as json_file:
+            baseline = json.load(json_file)
+        regressed = False
+        for milestone, seconds in result.items():
+            if milestone in baseline and seconds > baseline[milestone] * (1 + args.check / 100):
+                print('%s regressed: %.1f ms, baseline %.1f ms' % (
+                    milestone, seconds * 1000, baseline[milestone] * 1000))
+                regressed = True
+        sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
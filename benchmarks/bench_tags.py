@@ -0,0 +1,85 @@
+"""
+TagParser against the previous character by character GUIBackend.extract_tags
+with a linear get_keys, on long notes and large tag vocabularies.
+
+    python -m benchmarks.bench_tags [--tags 10000]
+"""
+import argparse
+import random
+import timeit
+
+from classes.tags import TagParser
+
+
+class PreviousExtractor():
+    def __init__(self, tags):
+        self.tags = tags
+
+    def extract_tags(self, text):
+        tag_temp = []
+        indices = [-1, -1]
+        tag_start = False
+        tag_stop = False
+        tag_nr = 0
+        for idx, letter in enumerate(text):
+            if letter == "#":
+                tag_start = True
+            if tag_start:
+                if indices[0] == -1:
+                    indices[0] = idx
+                if idx == len(text)-1:
+                    indices[1] = idx
+                    tag_start = False
+                    tag_stop = True
+                if letter == " ":
+                    indices[1] = idx-1
+                    tag_start = False
+                    tag_stop = True
+            if tag_stop:
+                tag_temp.append({'indices': [indices[0]-tag_nr, indices[1]-tag_nr],
+                                    'key': self.get_keys(text[indices[0]+1:indices[1]+1])})
+                tag_stop = False
+                tag_nr += 1
+                indices = [-1, -1]
+        return tag_temp
+
+    def get_keys(self, tag_value):
+        for tag in self.tags["tags"]:
+            if tag_value == tag["label"]:
+                return tag["key"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tags', type=int, default=10000)
+    parser.add_argument('--words', type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    vocabulary = {'tags': [{'key': str(i), 'label': 'tag%d' % i} for i in range(args.tags)],
+                  'mentions': [{'key': 'm%d' % i, 'label': 'user%d' % i} for i in range(args.tags)]}
+    words = []
+    for _ in range(args.words):
+        roll = random.random()
+        if roll < 0.1:
+            words.append('#tag%d' % random.randrange(args.tags))
+        elif roll < 0.15:
+            words.append('@user%d' % random.randrange(args.tags))
+        else:
+            words.append('word')
+    note = ' '.join(words)
+
+    previous = PreviousExtractor(vocabulary)
+    tag_parser = TagParser(vocabulary)
+    print('note of %d characters, %d tags and %d mentions in the vocabulary' % (
+        len(note), args.tags, args.tags))
+    for label, function in (('previous', lambda: previous.extract_tags(note)),
+                            ('parser', lambda: tag_parser.parse(note))):
+        seconds = min(timeit.repeat(function, number=1, repeat=3))
+        print('%-9s %9.2f ms' % (label, seconds * 1000))
+    seconds = min(timeit.repeat(lambda: TagParser(vocabulary), number=1, repeat=3))
+    print('%-9s %9.2f ms' % ('index', seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
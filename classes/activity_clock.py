@@ -0,0 +1,138 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from .timeular import parse_time
+
+
+def to_epoch(timestamp):
+    """
+    Epoch of an API timestamp, UTC with or without offset.
+    """
+    try:
+        moment = parse_time(timestamp)
+    except ValueError:
+        moment = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ActivityClock():
+    """
+    Elapsed time of the current activity and the time tracked today and
+    this week. The start of an activity is parsed once and anchored to
+    `time.monotonic` when the activity starts; afterwards the clock only
+    reads `time.monotonic`, so a tick costs a subtraction and a wall clock
+    jump (e.g. an NTP sync after boot) doesn't change the times shown.
+    The totals cover the activities tracked since the application
+    started, split at the local midnight.
+    """
+    def __init__(self):
+        self._anchor()
+        self.started_at = None
+        self.tracked = False
+        self._day_start = self._week_start = self._next_day = None
+        self._day_total = self._week_total = 0.0
+
+    def _anchor(self):
+        self._epoch = time.time()
+        self._monotonic = time.monotonic()
+
+    def now(self):
+        """
+        Current epoch, derived from the monotonic anchor taken at the start
+        of the activity.
+        """
+        return self._epoch + time.monotonic() - self._monotonic
+
+    def start(self, timestamp, tracked=True):
+        """
+        Closes the running activity at `timestamp` and starts the next one.
+
+        Parameters
+        ----------
+        timestamp : string
+            API timestamp of the start, in UTC
+        tracked : bool
+            False if nothing is tracked from now on, e.g. paused
+        """
+        started_at = to_epoch(timestamp)
+        self._close(started_at)
+        # the start timestamps come from the wall clock, so does the anchor
+        self._anchor()
+        self.started_at = started_at
+        self.tracked = tracked
+
+    def stop(self, count=True):
+        """
+        Stops the running activity. With `count` False, e.g. after the
+        server rejected it, its time isn't added to the totals.
+        """
+        if count:
+            self._close(self.now())
+        self._anchor()
+        self.started_at = None
+        self.tracked = False
+
+    def _close(self, stopped_at):
+        if self.started_at is None or not self.tracked:
+            return
+        self._roll(stopped_at)
+        self._day_total += self._overlap(self._day_start, stopped_at)
+        self._week_total += self._overlap(self._week_start, stopped_at)
+
+    def _overlap(self, since, until):
+        return max(0.0, until - max(self.started_at, since))
+
+    def _roll(self, now):
+        """
+        Resets the totals once the local day or week changed.
+        """
+        if self._day_start is not None and self._day_start <= now < self._next_day:
+            return
+        midnight = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0,
+                                                       microsecond=0)
+        # local arithmetic, the days around a DST change last 23 or 25 hours
+        self._next_day = (midnight + timedelta(days=1)).timestamp()
+        day_start = midnight.timestamp()
+        week_start = (midnight - timedelta(days=midnight.weekday())).timestamp()
+        if day_start != self._day_start:
+            self._day_total = 0.0
+            self._day_start = day_start
+        if week_start != self._week_start:
+            self._week_total = 0.0
+            self._week_start = week_start
+
+    def elapsed(self):
+        """
+        Seconds since the start of the activity, None if there is none.
+        """
+        if self.started_at is None:
+            return None
+        return max(0.0, self.now() - self.started_at)
+
+    def totals(self):
+        """
+        Seconds tracked (today, this week), the running activity included.
+        """
+        now = self.now()
+        self._roll(now)
+        today, week = self._day_total, self._week_total
+        if self.started_at is not None and self.tracked:
+            today += self._overlap(self._day_start, now)
+            week += self._overlap(self._week_start, now)
+        return today, week
+
+    def next_tick(self):
+        """
+        Milliseconds until the elapsed time reaches the next whole second.
+        """
+        elapsed = self.elapsed()
+        if elapsed is None:
+            return 1000
+        return 1000 - int(elapsed * 1000) % 1000
@@ -1,6 +1,11 @@
 from bluepy import btle
+import os
 import struct
-from utils.wrapper import check_bluetooth
+import threading
+import time
+import random
+from collections import deque, namedtuple
+from classes.gatt_cache import GattHandleCache
 
 import logging
 _log = logging.getLogger(__name__)
@@ -14,12 +19,32 @@ def _ZEI_UUID(short_uuid):
     return 'c7e7%04X-c847-11e6-8175-8c89a55d403c' % (short_uuid)
 
 class ZeiCharBase:
+    _NOTIFY = struct.pack("<H", 2)
 
     def __init__(self, periph):
         self.periph = periph
         self.hndl = None
+        self.cccd_hndl = None
+
+    def enable(self, handle_cache=None):
+        """
+        Enables the notifications of the characteristic. With a
+        `handle_cache`, the CCCD handle resolved on a previous connection is
+        written directly and the service discovery only runs if that fails.
+        """
+        if handle_cache is not None:
+            handles = handle_cache.get(self.periph.addr, self.charUUID)
+            if handles is not None:
+                try:
+                    self.periph.writeCharacteristic(handles[1], self._NOTIFY, withResponse=True)
+                    self.hndl, self.cccd_hndl = handles
+                    return
+                except btle.BTLEDisconnectError:
+                    raise
+                except btle.BTLEException:
+                    _log.info("Cached handles of %s are stale", self.charUUID)
+                    handle_cache.forget(self.periph.addr, self.charUUID)
 
-    def enable(self):
         _svc = self.periph.getServiceByUUID(self.svcUUID)
         _chr = _svc.getCharacteristics(self.charUUID)[0]
         self.hndl = _chr.getHandle()
@@ -27,7 +52,11 @@ class ZeiCharBase:
         # this is uint16_t - see:
         # https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.descriptor.gatt.client_characteristic_configuration.xml
         _cccd = _chr.getDescriptors(btle.AssignedNumbers.client_characteristic_configuration)[0]
-        _cccd.write(struct.pack("<H", 2), withResponse=True)
+        _cccd.write(self._NOTIFY, withResponse=True)
+        self.cccd_hndl = _cccd.handle
+
+        if handle_cache is not None:
+            handle_cache.set(self.periph.addr, self.charUUID, self.hndl, self.cccd_hndl)
 
 class ZeiOrientationChar(ZeiCharBase):
     svcUUID = _ZEI_UUID(0x0010)
@@ -43,16 +72,107 @@ class BatteryLevelChar(ZeiCharBase):
     def __init__(self, periph):
         ZeiCharBase.__init__(self, periph)
 
+SideEvent = namedtuple('SideEvent', ['side'])
+BatteryEvent = namedtuple('BatteryEvent', ['level'])
+
+class NotificationDecoder():
+    """
+    Turns the notifications of a ZEI into typed events. The decoders are
+    registered by characteristic UUID and looked up by the handles resolved
+    on the connection, so there is no handle number hard-coded.
+    """
+    # characteristic UUID -> (payload layout, event)
+    DECODERS = {
+        str(ZeiOrientationChar.charUUID): (struct.Struct('<B'), SideEvent),
+        str(BatteryLevelChar.charUUID): (struct.Struct('<B'), BatteryEvent),
+    }
+
+    def __init__(self):
+        self._handles = {}
+
+    def register(self, char):
+        """
+        Decodes the notifications of `char`, an enabled `ZeiCharBase`.
+        """
+        self._handles[char.hndl] = self.DECODERS[str(char.charUUID)]
+
+    def decode(self, handle, data):
+        """
+        Returns the event of a notification, None if its handle or its
+        payload is unknown.
+        """
+        decoder = self._handles.get(handle)
+        if decoder is None or len(data) < decoder[0].size:
+            return None
+        return decoder[1]._make(decoder[0].unpack_from(data))
+
+class HelperOutput():
+    """
+    Reads the lines of the bluepy helper from its pipe in place of the text
+    wrapper of `subprocess`. The lines read ahead stay in a buffer that a
+    poll of the descriptor doesn't see, this one tells whether a complete
+    line is waiting there.
+    """
+    def __init__(self, stream):
+        # keeps the wrapper alive, it owns the descriptor
+        self._stream = stream
+        self._fd = stream.fileno()
+        self._buffer = b''
+        self._eof = False
+
+    def fileno(self):
+        return self._fd
+
+    def has_line(self):
+        return self._eof or b'\n' in self._buffer
+
+    def readline(self):
+        while not self._eof and b'\n' not in self._buffer:
+            chunk = os.read(self._fd, 65536)
+            if not chunk:
+                self._eof = True
+            self._buffer += chunk
+        line, newline, self._buffer = self._buffer.partition(b'\n')
+        return (line + newline).decode('utf-8')
+
+    def close(self):
+        self._stream.close()
+
+
 class Zei(btle.Peripheral):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, handle_cache=None, battery=False, **kwargs):
         btle.Peripheral.__init__(self, *args, **kwargs)
-        
+        self.decoder = NotificationDecoder()
+
         # activate notifications about turn
         self.orientation = ZeiOrientationChar(self)
-        self.orientation.enable()
+        self.orientation.enable(handle_cache)
+        self.decoder.register(self.orientation)
+
+        self.battery = None
+        if battery:
+            self.battery = BatteryLevelChar(self)
+            self.battery.enable(handle_cache)
+            self.decoder.register(self.battery)
+
+    def _startHelper(self, iface=None):
+        started = self._helper is None
+        btle.Peripheral._startHelper(self, iface)
+        if started:
+            self._helper.stdout = HelperOutput(self._helper.stdout)
+
+    def has_buffered(self):
+        """
+        True if a line of the helper was read ahead and is still waiting,
+        `waitForNotifications(0)` then handles it without blocking.
+        """
+        return self._helper is not None and self._helper.stdout.has_line()
 
     def set_handler(self, handler):
+        """
+        `handler` is called with every decoded event, e.g. a `SideEvent`.
+        """
         self._handler = handler
         self.withDelegate(ZeiDelegate(self, self._handler))
 
@@ -63,15 +183,14 @@ class ZeiDelegate(btle.DefaultDelegate):
         btle.DefaultDelegate.__init__(self)
         self.parent = periph
         self.ble_handler = handler
+        self.decode = periph.decoder.decode
 
     def handleNotification(self, cHandle, data):
-        self.ble_handler(cHandle, data)
-
-        if cHandle == 39:
-            side = struct.unpack('B', data)
-            _log.info("Current side up is %s", side)
-        else:
-            _log.info("Notification from hndl: %s - %r", cHandle, data)
+        event = self.decode(cHandle, data)
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("Notification from hndl: %s - %r: %s", cHandle, data, event)
+        if event is not None:
+            self.ble_handler(event)
 
 class ZeiDiscovery(btle.Scanner):
 
@@ -79,14 +198,82 @@ class ZeiDiscovery(btle.Scanner):
         self.zei = periph
         btle.Scanner.__init__(self, **kwargs)
 
-    def reconnect(self):
+    def reconnect(self, timeout=10.0):
+        """
+        Scans for at most `timeout` seconds and reconnects once the ZEI
+        advertised. Returns False if it didn't.
+        """
         self.iface=self.zei.iface
         self.clear()
         self.start()
-        while self.zei.addr not in self.scanned:
-            self.process(timeout=2)
-        self.stop()
+        deadline = time.monotonic() + timeout
+        try:
+            while self.zei.addr not in self.scanned:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.process(timeout=min(2, remaining))
+        finally:
+            self.stop()
         self.zei.connect(self.scanned[self.zei.addr])
+        return True
+
+class Backoff():
+    """
+    Bounded exponential backoff with full jitter.
+    """
+    def __init__(self, minimum=1.0, maximum=60.0, factor=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.maximum, self.minimum * self.factor ** self.attempts)
+        self.attempts += 1
+        return random.uniform(self.minimum, delay) if delay > self.minimum else delay
+
+    def reset(self):
+        self.attempts = 0
+
+class ZeiScanDelegate(btle.DefaultDelegate):
+    """
+    Hands every advertisement to `on_device` as soon as it is received,
+    each address only once. The addresses of `accept` pass the ZEI filter
+    whatever they advertise.
+    """
+    _SERVICE_TAGS = (btle.ScanEntry.INCOMPLETE_128B_SERVICES,
+                     btle.ScanEntry.COMPLETE_128B_SERVICES)
+    _NAME_TAGS = (btle.ScanEntry.SHORT_LOCAL_NAME,
+                  btle.ScanEntry.COMPLETE_LOCAL_NAME)
+    _ZEI_SERVICES = (_ZEI_UUID(0x0010),)
+
+    def __init__(self, on_device, zei_only=True, accept=()):
+        btle.DefaultDelegate.__init__(self)
+        self.on_device = on_device
+        self.zei_only = zei_only
+        self.accept = set(address.lower() for address in accept)
+        self.seen = set()
+
+    @classmethod
+    def is_zei(cls, device):
+        for tag in cls._SERVICE_TAGS:
+            services = device.getValue(tag) or []
+            if any(str(uuid).lower() in cls._ZEI_SERVICES for uuid in services):
+                return True
+        for tag in cls._NAME_TAGS:
+            name = device.getValue(tag) or ''
+            if 'zei' in name.lower() or 'timeular' in name.lower():
+                return True
+        return False
+
+    def handleDiscovery(self, device, isNewDev, isNewData):
+        if device.addr in self.seen:
+            return
+        if self.zei_only and device.addr not in self.accept and not self.is_zei(device):
+            return
+        self.seen.add(device.addr)
+        self.on_device(device)
 
 class BluetoothBackend():
     """
@@ -101,53 +288,203 @@ class BluetoothBackend():
     adjust or modify the GUI. Still not sure if those sections are appropirate
     or whether they should be seperated entirely.
     """
+    DISCONNECTED = 'disconnected'
+    SCANNING = 'scanning'
+    CONNECTING = 'connecting'
+    SUBSCRIBED = 'subscribed'
+
     zei = None
     scanner = None
+    handle_cache = None
+    ble_thread = None
+    ble_stop = None
+    ble_state = DISCONNECTED
+    scan_denied = False
+    reconnect_latencies = ()
     delimiter = '\n'.encode('ascii')
 
     def discover_nearby_devices(self):
         """
-        Scan for any nearby devices and display their address. If nothing was found,
-        display an error message stating as such.
+        Scan for nearby ZEI devices in a worker thread and display their
+        address as soon as they advertise. If nothing was found, display an
+        error message stating as such.
         """
         self.display_message('Searching for nearby devices...')
-        devices = btle.Scanner().scan(10.0)
-        if devices:
-            self.display_message('Found the following devices: ')
-            for device in devices:
-                self.display_message('{0}: {1}'.format(device.addr, device.getValue(0x08)))
-        else:
-            self.display_message_box('showerror', 'Error', 'Unable to find any devices')
+        def scan():
+            self.message_queue.put(('scan_done', len(self.scan_for_zei())))
+        threading.Thread(target=scan, daemon=True).start()
 
-    def connect_to_zei(self, adress, handler):
+    def scan_for_zei(self, duration=10.0, stop_at=None, zei_only=True, stop=None):
+        """
+        Streams the devices found to the message queue while scanning, the
+        scan ends after `duration` seconds, once `stop_at` advertised or
+        when the `stop` event is set.
+
+        Returns
+        -------
+        found : list of btle.ScanEntry
+            The devices found, in the order they advertised
+        """
+        found = []
+        def on_device(device):
+            found.append(device)
+            self.message_queue.put(('message', 'Found {0}: {1}'.format(
+                device.addr, device.getValue(btle.ScanEntry.SHORT_LOCAL_NAME))))
+
+        # the configured tracker is accepted even if it doesn't look like a ZEI
+        accept = (stop_at,) if stop_at else ()
+        scanner = btle.Scanner().withDelegate(ZeiScanDelegate(on_device, zei_only, accept))
+        deadline = time.monotonic() + duration
+        try:
+            scanner.clear()
+            scanner.start()
+            while time.monotonic() < deadline:
+                scanner.process(timeout=min(0.5, max(deadline - time.monotonic(), 0.01)))
+                if stop_at and any(device.addr == stop_at.lower() for device in found):
+                    break
+                if stop is not None and stop.is_set():
+                    break
+        except btle.BTLEManagementError as e:
+            # scanning needs root or CAP_NET_ADMIN, connecting doesn't
+            self.scan_denied = True
+            self.message_queue.put(('message', 'Error: {0}'.format(e)))
+        except btle.BTLEException as e:
+            self.message_queue.put(('message', 'Error: {0}'.format(e)))
+        finally:
+            try:
+                scanner.stop()
+            except btle.BTLEException:
+                pass
+        return found
+
+    def connect_to_zei(self, adress, handler, addr_type='random'):
         self.mac_address = adress
         self.gui_handler = handler
-        self.zei = Zei(adress, 'random', iface=0)
+        if self.handle_cache is None:
+            self.handle_cache = GattHandleCache()
+        self.zei = Zei(adress, addr_type, iface=0, handle_cache=self.handle_cache)
         self.zei.set_handler(self.gui_handler)
         self.scanner = ZeiDiscovery(self.zei)
 
+    def start_notification_thread(self, adress, handler):
+        """
+        Connects to the ZEI and waits for its notifications in a worker
+        thread, the GUI thread never blocks on the peripheral. `handler` is
+        called on that thread and has to hand its results over through the
+        message queue. The thread keeps the connection up until
+        `close_connection` is called, see `notification_loop`.
+        """
+        self.ble_stop = threading.Event()
+        self.ble_thread = threading.Thread(target=self.notification_loop,
+                                           args=(adress, handler, self.ble_stop),
+                                           daemon=True)
+        self.ble_thread.start()
+
+    def set_ble_state(self, state):
+        self.ble_state = state
+        self.message_queue.put(('ble_state', state))
+
+    def notification_loop(self, adress, handler, stop, scan_timeout=10.0, backoff=None):
+        """
+        Connection state machine of the notification thread:
+
+        disconnected -> scanning -> connecting -> subscribed
+             ^                          |             |
+             +--------------------------+-------------+
+
+        It connects directly first. Failed connections and lost links go
+        back to disconnected, where it waits with a bounded exponential
+        backoff before scanning, which also finds the address type of the
+        ZEI. Once a scan was denied (it needs root or CAP_NET_ADMIN) it
+        reconnects without scanning. The time from a lost link to the next
+        subscription is kept in `reconnect_latencies`.
+        """
+        backoff = backoff or Backoff(1.0, 60.0)
+        self.reconnect_latencies = deque(maxlen=50)
+        addr_type = 'random'
+        lost_at = None
+        error_shown = False
+        self.set_ble_state(self.CONNECTING)
+        try:
+            while not stop.is_set():
+                if self.ble_state == self.DISCONNECTED:
+                    if not stop.wait(backoff.next()):
+                        self.set_ble_state(self.CONNECTING if self.scan_denied else self.SCANNING)
+
+                elif self.ble_state == self.SCANNING:
+                    # connect as soon as the ZEI advertises instead of blocking on it
+                    for device in self.scan_for_zei(duration=scan_timeout, stop_at=adress, stop=stop):
+                        if device.addr == adress.lower():
+                            addr_type = device.addrType
+                    self.set_ble_state(self.CONNECTING)
+
+                elif self.ble_state == self.CONNECTING:
+                    try:
+                        self.connect_to_zei(adress, handler, addr_type)
+                    except btle.BTLEException as e:
+                        self.remove_zei()
+                        # the dialog is shown once, the retries are only logged
+                        if error_shown:
+                            self.message_queue.put(('message', 'Error: {0}'.format(e)))
+                        else:
+                            error_shown = True
+                            self.message_queue.put(('ble_error', str(e)))
+                        self.set_ble_state(self.DISCONNECTED)
+                        continue
+                    backoff.reset()
+                    error_shown = True
+                    if lost_at is not None:
+                        latency = time.monotonic() - lost_at
+                        self.reconnect_latencies.append(latency)
+                        self.message_queue.put(('message', 'Reconnected to {0} in {1:.1f}s'
+                                                .format(adress, latency)))
+                        lost_at = None
+                    else:
+                        self.message_queue.put(('ble_connected', adress))
+                    self.set_ble_state(self.SUBSCRIBED)
+
+                elif self.ble_state == self.SUBSCRIBED:
+                    # returns as soon as a notification was handled
+                    if not self.wait_for_notification(timeout=0.5):
+                        lost_at = time.monotonic()
+                        self.message_queue.put(('message', 'Lost connection to {0}'.format(adress)))
+                        self.set_ble_state(self.DISCONNECTED)
+        finally:
+            try:
+                if self.zei:
+                    self.zei.disconnect()
+            finally:
+                self.remove_zei()
+                self.set_ble_state(self.DISCONNECTED)
+                self.message_queue.put(('ble_closed', adress))
+
+    def is_notification_thread_running(self):
+        return self.ble_thread is not None and self.ble_thread.is_alive()
+
     def wait_for_notification(self, timeout=0.5):
+        """
+        Returns False if there is no ZEI or its connection was lost.
+        """
         if self.zei:
             try:
                 self.zei.waitForNotifications(timeout=timeout)
                 return True
             except btle.BTLEDisconnectError:
-                self.connect_to_zei(self.mac_address, self.gui_handler)
-                return True
+                self.remove_zei()
+                return False
         else:
             return False 
 
-    def the_connection_was_lost(self):
-        self.display_message_box('showerror','Error','The connection was lost')
-        self.close_connection()
-
     def remove_zei(self):
         self.zei = None
 
-    @check_bluetooth
     def close_connection(self):
-        try:
-            self.zei.disconnect()
-        finally:
-            self.remove_zei()
-            self.display_message('Closed connection')
+        """
+        Asks the notification thread to disconnect or to stop reconnecting,
+        'Closed connection' is shown once it did.
+        """
+        if not self.is_notification_thread_running():
+            self.display_message_box('showerror', 'No Connection',
+                'You need to have an active Bluetooth connection first.')
+            return
+        self.ble_stop.set()
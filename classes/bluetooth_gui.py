@@ -1,10 +1,13 @@
 import tkinter as tk
 import json
-import webbrowser
 import struct
-from tkinter import filedialog
-from classes.bluetooth_backend import BluetoothBackend
+from concurrent.futures import ThreadPoolExecutor
+from classes.bluetooth_backend import BluetoothBackend, Backoff
 from classes.gui_backend import GUIBackend
+from classes.journal import TrackingJournal
+from classes.tracking_pipeline import TrackingPipeline
+from classes.log_sink import LogSink
+from classes.activity_clock import ActivityClock
 import tkinter.scrolledtext as tkScrollText
 from tkinter import messagebox
 from .modals.settings_modal import SettingsWindow
@@ -81,6 +84,7 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
             columnspan=60,
             sticky="nswe")
         self.log_display.bind("<1>", lambda event: self.log_display.focus_set())
+        self.log_sink = LogSink(widget=self.log_display, root=self.root)
 
         #  Activity   
         tk.Label(root, text="Actual Activity").grid(row=0, column=0, columnspan=35)
@@ -97,6 +101,7 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
             columnspan=30,
             sticky="nswe")
         self.text_activity.focus_set()
+        self.text_activity.bind('<KeyRelease>', self.schedule_note_autosave)
 
         button = tk.Button(root, text="Save", 
                         command=self.save_note_on_task).grid(row=4, column=35, columnspan=30)
@@ -111,16 +116,27 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
         self.timeular_status.set("Timeular not connected")
 
         # Load settings
-        self.octahedron_side = None
-        self.activity_id = None
-        self.start_time = None
+        self.activity_clock = ActivityClock()
+        self.flip_sequence = 0
+        self.flip_debouncer = None
+        self.settle_flip_job = None
+        self.autosave_job = None
+        self.saved_note = None
         self.read_data()
+        self.log_sink.resize(self.log_lines)
 
         # Timeular API connector
         self.timeular = None
+        self.sign_in_job = None
+        self.sign_in_backoff = Backoff(1.0, 300.0)
+        self.journal = TrackingJournal()
+        self.pipeline = TrackingPipeline(self.journal, merge_window=self.merge_window)
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='timeular')
+        self.journal_replayer = None
         
         # Time start loop
         self.root.after(5000, self.update_gui)
+        self.root.after(1000, self.tick_activity_clock)
 
     def display_message_box(self, the_type, title, text):
         """
@@ -150,14 +166,9 @@ check_ble_notification
             If there is any additonal information we want to display within
             our message which we couldn't do otherwise.
         """
-        self.enable_log_display_state()
         if data:
-            self.log_display.insert('end', message.format(data) + '\n')
-        else:
-            self.log_display.insert('end', message + '\n')
-        self.log_display.see('end')
-        self.update_log_display()
-        self.disable_log_display_state()
+            message = message.format(data)
+        self.log_sink.write(message)
         
     def disable_log_display_state(self):
         """
@@ -171,15 +182,6 @@ check_ble_notification
         """
         self.log_display.configure(state='normal')
 
-    def update_log_display(self):
-        """
-        When called will force our chat display widget to refresh any changes
-        which may be waiting to be shown. If we don't call this, then certain
-        things may not be shown in the order or at the time we want them to be
-        shown.
-        """
-        self.log_display.update_idletasks()  
-
     def update_gui(self):
         #_log.info("updating gui")
         # ble notification update
@@ -187,7 +189,6 @@ check_ble_notification
         self.root.after(2000, self.update_gui)
         self.check_tracker_notifications()
         self.check_timeular_status()
-        self.check_activity_time()
 
     def create_setting_gui(self):
         settings = SettingsWindow(self.root, title='Settings')
@@ -196,19 +197,16 @@ check_ble_notification
         """
         Connect to the ZEI device
         """
-        if self.zei:
+        if self.zei or self.is_notification_thread_running():
             self.display_message_box('showerror','Already Connected','Disconnect your zei before attempting to connect to another zei.')
         else:
             self.read_data()
             if self.address_value:
-                try:
-                    self.connect_to_zei(self.address_value, self.manage_received_notification)
-                    self.display_message('Connected Succesfully to {0}'.format(self.address_value))
-                except Exception as e:
-                    self.display_message('Error: {0}'.format(e))
-                    self.display_message_box('showerror', 'Error', 'Connection Failed')
+                self.display_message('Connecting to {0}...'.format(self.address_value))
+                self.start_notification_thread(self.address_value, self.manage_received_notification)
             if self.apikey_value and self.apisecret_value:
                 self.connect_to_timeular()
     
     def get_help(self):
+        import webbrowser
         webbrowser.open('https://lemariva.com/linker/timeular')
@@ -0,0 +1,56 @@
+import time
+
+
+class FlipDebouncer():
+    """
+    Reduces the burst of side notifications sent while the tracker settles
+    to the last side, stamped with the time of the first notification of
+    the burst.
+    """
+    def __init__(self, window=0.8):
+        """
+        Parameters
+        ----------
+        window : float
+            Seconds without a new notification after which the side is settled
+        """
+        self.window = window
+        self.side = None
+        self.timestamp = None
+        self.deadline = None
+
+    def push(self, side, timestamp, now=None):
+        """
+        Registers a notification, it restarts the settling window.
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.deadline is None:
+            self.timestamp = timestamp
+        self.side = side
+        self.deadline = now + self.window
+
+    def settle(self, now=None):
+        """
+        Returns the (side, timestamp) of the burst once the window expired,
+        None while the tracker is still moving or if there is nothing pending.
+        """
+        if self.deadline is None:
+            return None
+        if now is None:
+            now = time.monotonic()
+        if now < self.deadline:
+            return None
+        settled = (self.side, self.timestamp)
+        self.side = self.timestamp = self.deadline = None
+        return settled
+
+    def remaining(self, now=None):
+        """
+        Seconds until the pending burst settles, None if nothing is pending.
+        """
+        if self.deadline is None:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(self.deadline - now, 0)
@@ -0,0 +1,82 @@
+class FrameDecoder():
+    """
+    Incremental decoder of delimiter framed byte streams. Data is received
+    straight into a preallocated buffer with `recv_into`, every complete
+    frame is returned and the bytes of a partial frame are kept for the next
+    chunk.
+    """
+    def __init__(self, delimiter=b'\n', buffer_size=65536):
+        """
+        Parameters
+        ----------
+        delimiter : bytes
+            Sequence ending every frame, it isn't part of the frames returned
+        buffer_size : int
+            Initial size of the receive buffer, it grows for larger frames
+        """
+        self.delimiter = delimiter
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._scanned = 0
+
+    def recv_into(self, sock, size=None):
+        """
+        Receives the next chunk from `sock` into the buffer.
+
+        Returns
+        -------
+        received : int
+            Number of bytes received, 0 once the peer closed the connection
+        """
+        self._reserve(size or 1)
+        free = self._view[self._end:] if size is None else self._view[self._end:self._end + size]
+        received = sock.recv_into(free)
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """
+        Appends `data` to the buffer, for streams which aren't sockets.
+        """
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self):
+        """
+        Yields every complete frame in the buffer, in order.
+        """
+        delimiter = self.delimiter
+        find = self._buffer.find
+        while True:
+            index = find(delimiter, self._scanned, self._end)
+            if index < 0:
+                self._scanned = max(self._start, self._end - len(delimiter) + 1)
+                break
+            frame = bytes(self._view[self._start:index])
+            self._start = self._scanned = index + len(delimiter)
+            yield frame
+        if self._start == self._end:
+            self._start = self._end = self._scanned = 0
+
+    def pending(self):
+        """
+        Number of buffered bytes of the frame not completed yet.
+        """
+        return self._end - self._start
+
+    def _reserve(self, size):
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start:
+            # move the partial frame to the front of the buffer
+            self._buffer[:pending] = self._view[self._start:self._end]
+            self._scanned -= self._start
+            self._start, self._end = 0, pending
+        if len(self._buffer) - self._end < size:
+            self._view.release()
+            self._buffer.extend(bytes(max(size, len(self._buffer))))
+            self._view = memoryview(self._buffer)
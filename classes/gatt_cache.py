@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+
+
+class GattHandleCache():
+    """
+    On-disk cache of the characteristic and CCCD handles resolved on every
+    ZEI, keyed by MAC address and characteristic UUID. It lets a reconnect
+    enable the notifications without running the service discovery again.
+    """
+    def __init__(self, path='gatt_cache.json'):
+        """
+        Parameters
+        ----------
+        path : string
+            Location of the JSON file, created on the first `set`
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as json_file:
+                self._handles = json.load(json_file)
+        except (OSError, ValueError):
+            self._handles = {}
+
+    def get(self, address, char_uuid):
+        """
+        Returns the (handle, cccd_handle) of the characteristic, None if
+        they weren't resolved yet.
+        """
+        with self._lock:
+            entry = self._handles.get(address.lower(), {}).get(str(char_uuid))
+        if entry is None:
+            return None
+        return entry['handle'], entry['cccd']
+
+    def set(self, address, char_uuid, handle, cccd_handle):
+        with self._lock:
+            self._handles.setdefault(address.lower(), {})[str(char_uuid)] = \
+                {'handle': handle, 'cccd': cccd_handle}
+            self._save()
+
+    def forget(self, address, char_uuid=None):
+        with self._lock:
+            if char_uuid is None:
+                self._handles.pop(address.lower(), None)
+            else:
+                self._handles.get(address.lower(), {}).pop(str(char_uuid), None)
+            self._save()
+
+    def _save(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as outfile:
+            json.dump(self._handles, outfile)
+        os.replace(temporary, self.path)
@@ -1,16 +1,12 @@
-import base64
-import codecs
-import tkinter as tk
-import os
 import queue
 import json
-import struct
-import datetime
-import dateutil.parser
 
-from .timeular import Timeular
-from PIL import Image
-from utils.wrapper import check_bluetooth
+from .timeular import Timeular, get_current_time
+from .activity_clock import format_duration
+from .journal import JournalReplayer
+from .bluetooth_backend import SideEvent, Backoff
+from .debounce import FlipDebouncer
+from . import startup
 
 import logging
 _log = logging.getLogger(__name__)
@@ -20,22 +16,84 @@ _log.setLevel(logging.NOTSET)
 class GUIBackend():
     """This is a class which our GUI inherits from. 
     """
+    def run_in_background(self, function, *args, callback=None):
+        """
+        Runs `function` in the worker pool. The optional `callback` gets the
+        finished future on the GUI thread, through the message queue, so it
+        is the only place where the result may touch Tk.
+        """
+        future = self.executor.submit(function, *args)
+        if callback is not None:
+            future.add_done_callback(
+                lambda future: self.message_queue.put(('callback', callback, future)))
+        return future
+
     def connect_to_timeular(self):
+        if self.sign_in_job is not None:
+            self.root.after_cancel(self.sign_in_job)
+            self.sign_in_job = None
+        self.actual_activity = None
+        previous, self.timeular = self.timeular, None
+        self.run_in_background(self.open_timeular, previous,
+                               self.apikey_value, self.apisecret_value,
+                               callback=self.timeular_connected)
+
+    def open_timeular(self, previous, apikey, apisecret):
+        """
+        Worker side of `connect_to_timeular`, it signs in and preloads the
+        activities, the current tracking and the tags.
+        """
+        if previous:
+            previous.close()
+        timeular = Timeular(apikey, apisecret)
         try:
-            self.actual_activity = None
-            self.timeular = Timeular(self.apikey_value, self.apisecret_value)
-            self.display_message('Connected to https://api.timeular.com/api/v2')
-            self.check_current_tracking()
-            self.tags = self.timeular.tags_and_mentions.get()
+            timeular.activities.get()
+            tracking = timeular.tracking.current(max_age=0)
+            tags = timeular.tags_and_mentions.get()
+        except Exception:
+            # the sign-in is retried with a new client
+            timeular.close()
+            raise
+        return timeular, tracking, tags
+
+    def timeular_connected(self, future):
+        try:
+            self.timeular, tracking, self.tags = future.result()
         except Exception as e:
             self.timeular = None
-            self.display_message('Error: {0}'.format(e))
-
-    def check_current_tracking(self):
-        tracking = self.timeular.tracking.get()["currentTracking"]
-        if tracking is not None:
+            # flips are journaled meanwhile, the sign-in is retried
+            delay = self.sign_in_backoff.next()
+            self.display_message('Error: {0}, retrying in {1:.0f}s'.format(e, delay))
+            self.sign_in_job = self.root.after(int(delay * 1000), self.connect_to_timeular)
+            return
+        self.sign_in_backoff.reset()
+        self.display_message('Connected to https://api.timeular.com/api/v2')
+        self.pipeline.client = self.timeular
+        self.pipeline.merge_window = self.merge_window
+        self.start_journal_replay()
+        # flips journaled while offline decide the tracking once replayed
+        if tracking is not None and not self.journal.pending_count():
             self.manage_activity_change(tracking=tracking)
-            
+
+    def start_journal_replay(self):
+        """
+        Opens the tracking journal and starts draining it with the current
+        Timeular client. Entries written while offline are sent now.
+        """
+        if self.journal_replayer is None:
+            self.journal_replayer = JournalReplayer(self.journal, on_result=self.journal_result,
+                                                    merge_window=self.merge_window)
+            self.journal_replayer.start()
+        self.journal_replayer.client = self.timeular
+        self.journal.wake()
+
+    def journal_result(self, event, message):
+        """
+        Called from the replayer thread, the message is shown by the GUI
+        thread through the message queue.
+        """
+        self.message_queue.put(('journal', event, message))
+
     def read_data(self):
         try:
             with open('data.json') as json_file:
@@ -43,73 +101,168 @@ class GUIBackend():
                 self.address_value = data['device_mac']
                 self.apikey_value = data['apiKey']
                 self.apisecret_value = data['apiSecret']
+                self.flip_window = data.get('flip_window', 0.8)
+                self.merge_window = data.get('merge_window', 5)
+                self.note_autosave = data.get('note_autosave', 0)
+                self.log_lines = data.get('log_lines', 500)
         except Exception as e:
             self.display_message('Error: {0}'.format(e))
             self.address_value = ""
             self.apikey_value = ""
             self.apisecret_value = ""
+            self.flip_window = 0.8
+            self.merge_window = 5
+            self.note_autosave = 0
+            self.log_lines = 500
             pass
 
-    def manage_received_notification(self, handle, data):
+    def manage_received_notification(self, event):
+        """
+        Called on the notification thread, the side is handed over to the
+        GUI thread through the message queue.
         """
+        if type(event) is SideEvent:
+            self.message_queue.put(('side', event.side, get_current_time()))
+
+    def debounce_flip(self, octahedron_side, timestamp):
+        """
+        Waits until the tracker settled before changing the activity, only
+        the last side of a burst of notifications is tracked.
+        """
+        if self.flip_debouncer is None or self.flip_debouncer.window != self.flip_window:
+            self.flip_debouncer = FlipDebouncer(self.flip_window)
+        self.flip_debouncer.push(octahedron_side, timestamp)
+        if self.settle_flip_job is not None:
+            self.root.after_cancel(self.settle_flip_job)
+        self.settle_flip_job = self.root.after(int(self.flip_window * 1000), self.settle_flip)
+
+    def settle_flip(self):
+        self.settle_flip_job = None
+        settled = self.flip_debouncer.settle()
+        if settled is None:
+            remaining = self.flip_debouncer.remaining()
+            if remaining is not None:
+                self.settle_flip_job = self.root.after(int(remaining * 1000) + 1, self.settle_flip)
+            return
+        octahedron_side, timestamp = settled
+        if octahedron_side != self.pipeline.octahedron_side:
+            self.manage_activity_change(octahedron_side=octahedron_side, timestamp=timestamp)
+
+    def manage_received_data(self, data):
         """
-        if handle == 39 or handle == 38:
-            # read the actual octahedron side
-            octahedron_side = struct.unpack('B', data)[0]
-            self.manage_activity_change(octahedron_side=octahedron_side)
+        Dispatches the items taken from the message queue.
+        """
+        if data[0] == 'side':
+            self.debounce_flip(data[1], data[2])
+        elif data[0] == 'callback':
+            data[1](data[2])
+        elif data[0] == 'journal':
+            self.journal_replayed(data[1], data[2])
+        elif data[0] == 'message':
+            self.display_message(data[1])
+        elif data[0] == 'scan_done':
+            if not data[1]:
+                self.display_message_box('showerror', 'Error', 'Unable to find any devices')
+        elif data[0] == 'ble_state':
+            if data[1] == self.SUBSCRIBED:
+                startup.mark('ble_subscribed')
+            self.check_tracker_notifications()
+        elif data[0] == 'ble_connected':
+            self.display_message('Connected Succesfully to {0}'.format(data[1]))
+        elif data[0] == 'ble_error':
+            self.display_message('Error: {0}'.format(data[1]))
+            self.display_message_box('showerror', 'Error', 'Connection Failed, retrying')
+        elif data[0] == 'ble_closed':
+            self.display_message('Closed connection')
+
+    def journal_replayed(self, event, message):
+        """
+        Corrects the optimistic update if the server rejected the start of
+        the activity shown.
+        """
+        self.message_to_text(message)
+        activity_name = self.pipeline.replayed(event, message)
+        if activity_name is not None:
+            self.activity_clock.tracked = self.pipeline.activity_id is not None
+            self.activity_name.set(activity_name)
+        if self.pipeline.rejected(event, message):
+            self.activity_clock.stop(count=False)
+            self.activity_name.set("Not tracked!")
+            self.activity_time.set("")
     
-    def manage_activity_change(self, octahedron_side = None, tracking = None):
-        message_stop = None
-        message_start = None
-        self.start_time = datetime.datetime.utcnow().isoformat()
-        
-        if octahedron_side is not None:
-            activity = self.timeular.activities.get_activitity_side(octahedron_side)
-        
-        if tracking is not None:
-            activity = self.timeular.activities.get_activity_id(tracking["activity"]["id"])
-            self.start_time = tracking["startedAt"]
-
-        if activity:
-            activity_name = activity["name"]
-            activity_id = activity["id"]
-            
-            if self.activity_id is not None:  
-                message_stop = self.timeular.tracking.post_stop(self.activity_id)
-
-            message_start = self.timeular.tracking.post_start(activity_id)
-                
+    def manage_activity_change(self, octahedron_side = None, tracking = None, timestamp = None):
+        """
+        The GUI is updated right away, the `TrackingPipeline` journals the
+        change with the time of the flip. If the activities have to be
+        (re)loaded, the lookup runs in the worker pool and the flip is
+        applied when it returns. Without Timeular connection or activities,
+        the side itself is journaled and resolved when it is replayed.
+        """
+        if self.timeular is None and octahedron_side is None:
+            self.display_message('Error: not connected to Timeular')
+            return
+        if timestamp is None:
+            timestamp = get_current_time()
+        self.flip_sequence += 1
+        self.activity_clock.start(tracking["startedAt"] if tracking is not None else timestamp)
+        self.check_activity_time()
+
+        if self.timeular is None:
+            self.activity_name.set(self.pipeline.defer(octahedron_side, timestamp))
+            self.display_message('Not connected to Timeular, side {0} is sent later'
+                                 .format(octahedron_side))
+            return
+        if self.pipeline.can_resolve_locally(tracking):
+            self.apply_activity_change(self.pipeline.resolve(octahedron_side, tracking),
+                                       octahedron_side, tracking, timestamp)
         else:
-            activity_id = None
-            message_stop = self.timeular.tracking.post_stop(self.activity_id)
-            if self.octahedron_side is not None:
-                activity_name = "Paused!"      
-            else:
-                activity_name = "Not defined!"
+            self.activity_name.set("Loading...")
+            sequence = self.flip_sequence
+            def resolved(future):
+                if sequence != self.flip_sequence:
+                    return
+                try:
+                    activity = future.result()
+                except Exception as e:
+                    self.display_message('Error: {0}'.format(e))
+                    if octahedron_side is not None:
+                        self.display_message('Side {0} is sent later'.format(octahedron_side))
+                        self.activity_name.set(self.pipeline.defer(octahedron_side, timestamp))
+                    return
+                self.apply_activity_change(activity, octahedron_side, tracking, timestamp)
+            self.run_in_background(self.pipeline.resolve, octahedron_side, tracking,
+                                   callback=resolved)
 
-        self.octahedron_side = octahedron_side
-        self.activity_id = activity_id
+    def apply_activity_change(self, activity, octahedron_side, tracking, timestamp):
+        self.activity_clock.tracked = bool(activity)
+        self.activity_name.set(self.pipeline.apply(activity, octahedron_side, tracking, timestamp))
 
-        # gui update
-        self.activity_name.set(activity_name)
-        self.message_to_text(message_stop)
-        self.message_to_text(message_start)
+    def tick_activity_clock(self):
+        """
+        Refreshes the activity time on every whole second of it.
+        """
+        self.check_activity_time()
+        self.root.after(self.activity_clock.next_tick(), self.tick_activity_clock)
 
     def check_activity_time(self):
-        if self.start_time is not None:
-            activity_time = datetime.datetime.utcnow().replace(microsecond=0) - \
-                            dateutil.parser.parse(self.start_time).replace(microsecond=0)
-            self.activity_time.set(activity_time)
+        elapsed = self.activity_clock.elapsed()
+        if elapsed is not None:
+            today, week = self.activity_clock.totals()
+            self.activity_time.set('{0}  (today {1}, week {2})'.format(
+                format_duration(elapsed), format_duration(today), format_duration(week)))
 
     def check_tracker_notifications(self):
-        if self.wait_for_notification():
+        if self.ble_state == self.SUBSCRIBED:
             self.zei_connector.set("Tracker connected")
+        elif self.ble_state in (self.SCANNING, self.CONNECTING) or \
+            (self.ble_state == self.DISCONNECTED and self.is_notification_thread_running()):
+            self.zei_connector.set("Tracker connecting...")
         else:
             self.zei_connector.set("Tracker not connected")
 
     def check_timeular_status(self):
         if self.timeular:
-            if not self.timeular.get_access_token():
+            if not self.timeular.is_connected():
                 self.timeular_status.set("Timeular not connected")
             else:
                 self.timeular_status.set("Timeular connected")
@@ -130,53 +283,51 @@ class GUIBackend():
 
     def save_note_on_task(self):
         if self.timeular:
-            tracking = self.timeular.tracking.get()["currentTracking"]
-            if tracking is not None:
-                note = self.text_activity.get("1.0","end").replace("\n","").replace("\t","")
-                if len(note) != 0:
-                    tags = self.extract_tags(note)
-                    _log.info(tags)
-                    activity_id = tracking["activity"]["id"]
-                    activity_name = tracking["activity"]["name"]
-                    tracking["note"]["text"] = note.replace("#","")
-                    tracking["note"]["tags"] = tags
-                    _log.info(tracking)
-                    message = self.timeular.tracking.patch(activity_id, tracking)
-                    self.display_message('[{0}] {1}: {2}'.format(activity_name, note, message))
-
-    def extract_tags(self, text):
-        tag_temp = []
-        indices = [-1, -1]
-        tag_start = False
-        tag_stop = False
-        tag_nr = 0
-        text_clean = text.replace("#", "")
-        for idx, letter in enumerate(text):
-            if letter == "#":
-                tag_start = True
-            if tag_start:
-                if indices[0] == -1:
-                    indices[0] = idx
-                if idx == len(text)-1:
-                    indices[1] = idx
-                    tag_start = False
-                    tag_stop = True
-                if letter == " ":
-                    indices[1] = idx-1
-                    tag_start = False
-                    tag_stop = True
-            if tag_stop:
-                tag_temp.append({'indices': [indices[0]-tag_nr, indices[1]-tag_nr],
-                                    'key': self.get_keys(text[indices[0]+1:indices[1]+1])})
-                tag_stop = False
-                tag_nr += 1
-                indices = [-1, -1]
-        return tag_temp
-
-    def get_keys(self, tag_value):
-        for tag in self.tags["tags"]:
-            if tag_value == tag["label"]:
-                return tag["key"]
+            note = self.text_activity.get("1.0","end").replace("\n","").replace("\t","")
+            # the same text is saved again once another activity is tracked
+            saved_note = (self.pipeline.activity_id, note)
+            if len(note) != 0 and saved_note != self.saved_note:
+                text, tags, mentions = self.timeular.tags_and_mentions.parser.parse(note)
+                _log.info(tags)
+                self.saved_note = saved_note
+                self.run_in_background(self.send_note, self.timeular, text, tags, mentions,
+                                       callback=self.note_saved)
+
+    def schedule_note_autosave(self, event=None):
+        """
+        Saves the note `note_autosave` seconds after the last key stroke,
+        a burst of edits is sent as one PATCH. Disabled if it is 0.
+        """
+        if not self.note_autosave:
+            return
+        if self.autosave_job is not None:
+            self.root.after_cancel(self.autosave_job)
+        self.autosave_job = self.root.after(int(self.note_autosave * 1000), self.autosave_note)
+
+    def autosave_note(self):
+        self.autosave_job = None
+        self.save_note_on_task()
+
+    def send_note(self, timeular, note, tags, mentions):
+        """
+        Worker side of `save_note_on_task`.
+        """
+        tracking, message = timeular.tracking.save_note(note, tags, mentions)
+        if tracking is None:
+            return None, None, None
+        return tracking["activity"]["name"], note, message
+
+    def note_saved(self, future):
+        try:
+            activity_name, note, message = future.result()
+        except Exception as e:
+            self.saved_note = None
+            self.display_message('Error: {0}'.format(e))
+            return
+        if message and "status_code" in message:
+            self.saved_note = None
+        if activity_name is not None:
+            self.display_message('[{0}] {1}: {2}'.format(activity_name, note, message))
 
     def check_message_queue(self):
         """
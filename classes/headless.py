@@ -0,0 +1,238 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+
+from .timeular import Timeular, get_current_time
+from .journal import TrackingJournal, JournalReplayer
+from .debounce import FlipDebouncer
+from .tracking_pipeline import TrackingPipeline
+from .multi_tracker import ZeiMultiplexer, read_trackers
+from .bluetooth_backend import SideEvent, Backoff
+from .log_sink import LogSink, SinkHandler
+
+_log = logging.getLogger(__name__)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, the fields passed with `extra={'fields': {...}}`
+    are merged into it.
+    """
+    def format(self, record):
+        entry = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def setup_logging(log_format='json', level=logging.INFO, log_file=None, max_lines=500):
+    """
+    Routes the logs to a `LogSink` writing to `log_file`, or stdout, and
+    keeping the last `max_lines` in memory. Returns the sink.
+    """
+    stream = open(log_file, 'a', buffering=1) if log_file else sys.stdout
+    sink = LogSink(max_lines, stream=stream)
+    handler = SinkHandler(sink)
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    # the modules log every request and notification on their own handlers
+    for name in ('classes.timeular', 'classes.journal', 'classes.bluetooth_backend',
+                 'classes.multi_tracker'):
+        module_log = logging.getLogger(name)
+        module_log.handlers = []
+        module_log.setLevel(logging.WARNING)
+    return sink
+
+
+class Account():
+    """
+    A Timeular account: its client, journal and replayer. The sign-in is
+    retried in the background until it succeeds. The pipelines belong to
+    the main loop: the client and the replay results are handed over to it
+    on `events` instead of touching the pipelines from these threads.
+    """
+    def __init__(self, api_key, api_secret, journal_dir='.', merge_window=0, events=None):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.name = hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:8]
+        self.client = None
+        self.pipelines = []
+        self.events = events if events is not None else queue.Queue()
+        self.journal = TrackingJournal(os.path.join(journal_dir, 'journal-%s.db' % self.name))
+        self.replayer = JournalReplayer(self.journal, on_result=self.replayed,
+                                        merge_window=merge_window)
+        self.replayer.start()
+
+    def connect(self, stop):
+        backoff = Backoff(1.0, 300.0)
+        while not stop.is_set():
+            try:
+                client = Timeular(self.api_key, self.api_secret)
+                try:
+                    client.activities.get()
+                except Exception:
+                    client.close()
+                    raise
+                break
+            except Exception as e:
+                _log.error('sign in failed', extra={'fields': {
+                    'account': self.name, 'error': str(e)}})
+                stop.wait(backoff.next())
+        else:
+            return
+        self.client = client
+        self.events.put(('connected', self, client))
+        self.replayer.client = client
+        _log.info('account connected', extra={'fields': {'account': self.name}})
+
+    def replayed(self, event, message):
+        """
+        Called on the replayer thread.
+        """
+        fields = {'account': self.name, 'action': event.action,
+                  'activity_id': event.activity_id, 'timestamp': event.timestamp}
+        if message and "status_code" in message:
+            fields['status_code'] = message["status_code"]
+            _log.warning('tracking rejected', extra={'fields': fields})
+        else:
+            _log.info('tracking sent', extra={'fields': fields})
+        self.events.put(('replayed', self, event, message))
+
+    def apply_result(self, event, message):
+        """
+        Updates the pipelines with a replay result, on the main loop.
+        """
+        for pipeline in self.pipelines:
+            if message and "status_code" in message:
+                pipeline.rejected(event, message)
+            else:
+                pipeline.replayed(event, message)
+
+
+class HeadlessTracker():
+    """
+    The BLE -> activity -> API pipeline without Tk. Every tracker of the
+    settings gets its own `TrackingPipeline` and debouncer, the trackers
+    sharing an account share its client and journal.
+    """
+    def __init__(self, data, journal_dir='.', flip_window=None, merge_window=None):
+        """
+        Parameters
+        ----------
+        data : dict
+            The settings, as read from data.json
+        journal_dir : string
+            Directory of the journals, one per account
+        flip_window, merge_window : float, optional
+            Override the values of the settings
+        """
+        if flip_window is None:
+            flip_window = data.get('flip_window', 0.8)
+        if merge_window is None:
+            merge_window = data.get('merge_window', 5)
+        self.flip_window = flip_window
+        self.events = queue.Queue()
+        self.stop_event = threading.Event()
+        self.accounts = {}
+        self.trackers = {}
+        for tracker in read_trackers(data):
+            key = (tracker.api_key, tracker.api_secret)
+            if key not in self.accounts:
+                account = Account(tracker.api_key, tracker.api_secret, journal_dir,
+                                  merge_window, self.events)
+                self.accounts[key] = account
+            account = self.accounts[key]
+            pipeline = TrackingPipeline(account.journal, merge_window=merge_window,
+                                        side_activities=tracker.activities)
+            account.pipelines.append(pipeline)
+            self.trackers[tracker.address] = (account, pipeline, FlipDebouncer(self.flip_window))
+        self.multiplexer = ZeiMultiplexer(self.notification, on_state=self.state_changed)
+
+    def notification(self, address, event):
+        """
+        Called on the BLE loop thread.
+        """
+        if type(event) is SideEvent:
+            self.events.put(('side', address, event.side, get_current_time()))
+
+    def state_changed(self, address, state):
+        _log.info('tracker %s' % state, extra={'fields': {'tracker': address, 'state': state}})
+
+    def run(self):
+        if not self.trackers:
+            raise ValueError('No tracker configured, set device_mac or trackers in data.json')
+        for account in self.accounts.values():
+            threading.Thread(target=account.connect, args=(self.stop_event,), daemon=True).start()
+        for address in self.trackers:
+            self.multiplexer.add(address)
+        ble_loop = threading.Thread(target=self.multiplexer.run, daemon=True)
+        ble_loop.start()
+        _log.info('started', extra={'fields': {'trackers': list(self.trackers)}})
+        try:
+            while not self.stop_event.is_set():
+                self.settle_flips(self.next_timeout())
+        finally:
+            self.multiplexer.stop()
+            for account in self.accounts.values():
+                account.replayer.stop()
+            ble_loop.join(2)
+            _log.info('stopped')
+
+    def next_timeout(self):
+        remaining = [debouncer.remaining() for _, _, debouncer in self.trackers.values()]
+        remaining = [seconds for seconds in remaining if seconds is not None]
+        return min(remaining) if remaining else 1.0
+
+    def settle_flips(self, timeout):
+        try:
+            item = self.events.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+        if item is not None:
+            self.handle_event(item)
+        for address, (account, pipeline, debouncer) in self.trackers.items():
+            settled = debouncer.settle()
+            if settled is None:
+                continue
+            side, timestamp = settled
+            fields = {'tracker': address, 'account': account.name, 'side': side,
+                      'timestamp': timestamp}
+            try:
+                # without client or activities the side is journaled as it is
+                fields['activity'] = pipeline.change_side(side, timestamp)
+                _log.info('flip', extra={'fields': fields})
+            except Exception as e:
+                fields['error'] = str(e)
+                _log.error('flip failed', extra={'fields': fields})
+
+    def handle_event(self, item):
+        """
+        Applies what the BLE loop, the sign-ins and the replayers queued,
+        the pipelines are only touched from the main loop.
+        """
+        if item[0] == 'side':
+            _, address, side, timestamp = item
+            self.trackers[address][2].push(side, timestamp)
+        elif item[0] == 'connected':
+            _, account, client = item
+            for pipeline in account.pipelines:
+                pipeline.client = client
+        elif item[0] == 'replayed':
+            _, account, event, message = item
+            account.apply_result(event, message)
+
+    def stop(self):
+        self.stop_event.set()
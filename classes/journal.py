@@ -0,0 +1,322 @@
+import sqlite3
+import threading
+import random
+import time
+from datetime import datetime
+from collections import namedtuple
+
+import logging
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.StreamHandler())
+_log.setLevel(logging.NOTSET)
+
+JournalEvent = namedtuple('JournalEvent', ['id', 'action', 'activity_id', 'timestamp', 'attempts'])
+
+class TrackingJournal():
+    """
+    Append-only SQLite journal of the tracking changes made with the tracker.
+    Every side change is stored with the time of the notification before
+    anything is sent to the API, the `JournalReplayer` drains it in order.
+
+    Besides the 'start' and 'stop' of an activity, a 'switch' makes an
+    activity (or none, '') the tracked one whatever ran before, and a
+    'side' is a tracker side whose activity is only resolved at replay,
+    when it was flipped without API access.
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    REJECTED = 'rejected'
+
+    def __init__(self, path='journal.db'):
+        """
+        Parameters
+        ----------
+        path : string
+            Location of the SQLite database, created if it doesn't exist
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS events (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                action TEXT NOT NULL,
+                                activity_id TEXT NOT NULL,
+                                timestamp TEXT NOT NULL,
+                                state TEXT NOT NULL DEFAULT 'pending',
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                response TEXT)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS events_state ON events (state, id)')
+
+    def append(self, action, activity_id, timestamp):
+        """
+        Stores a 'start', 'stop' or 'switch' of an activity, or a 'side'
+        with the side as `activity_id`, and wakes up the replayer.
+
+        Returns
+        -------
+        id : int
+            The id of the new journal entry
+        """
+        with self._changed:
+            cursor = self._db.execute(
+                'INSERT INTO events (action, activity_id, timestamp) VALUES (?, ?, ?)',
+                (action, str(activity_id), timestamp))
+            self._changed.notify_all()
+            return cursor.lastrowid
+
+    def append_switch(self, previous_id, activity_id, timestamp, merge_window=0):
+        """
+        Stores the switch from `previous_id` to `activity_id` (any of them can
+        be None). If the start of `previous_id` is still pending and happened
+        less than `merge_window` seconds before, that start is rewritten to
+        the new activity with its original timestamp instead of appending a
+        stop and a start.
+        """
+        with self._changed:
+            if previous_id is not None and merge_window:
+                last = self._db.execute(
+                    'SELECT id, action, activity_id, timestamp, attempts FROM events '
+                    'WHERE state = ? ORDER BY id DESC LIMIT 1', (self.PENDING,)).fetchone()
+                if last and last[1] == 'start' and last[2] == str(previous_id) and last[4] == 0 \
+                    and _seconds_between(last[3], timestamp) < merge_window:
+                    self._merge_start(last[0], activity_id)
+                    self._changed.notify_all()
+                    return last[0]
+            if previous_id is not None:
+                self._db.execute(
+                    'INSERT INTO events (action, activity_id, timestamp) VALUES (?, ?, ?)',
+                    ('stop', str(previous_id), timestamp))
+            event_id = None
+            if activity_id is not None:
+                event_id = self._db.execute(
+                    'INSERT INTO events (action, activity_id, timestamp) VALUES (?, ?, ?)',
+                    ('start', str(activity_id), timestamp)).lastrowid
+            self._changed.notify_all()
+            return event_id
+
+    def _merge_start(self, start_id, activity_id):
+        before = self._db.execute(
+            'SELECT id, action, activity_id, attempts FROM events '
+            'WHERE state = ? AND id < ? ORDER BY id DESC LIMIT 1',
+            (self.PENDING, start_id)).fetchone()
+        if activity_id is None:
+            self._db.execute('DELETE FROM events WHERE id = ?', (start_id,))
+        elif before and before[1] == 'stop' and before[2] == str(activity_id) and before[3] == 0:
+            # flipped back to the activity that was running, nothing changed
+            self._db.execute('DELETE FROM events WHERE id IN (?, ?)', (before[0], start_id))
+        else:
+            self._db.execute('UPDATE events SET activity_id = ? WHERE id = ?',
+                             (str(activity_id), start_id))
+
+    def next_pending(self, timeout=None):
+        """
+        Returns the oldest pending event, waiting up to `timeout` seconds for
+        one to be appended. None if there is nothing to replay.
+        """
+        with self._changed:
+            event = self._next_pending()
+            if event is None and timeout != 0:
+                self._changed.wait(timeout)
+                event = self._next_pending()
+            return event
+
+    def _next_pending(self):
+        row = self._db.execute(
+            'SELECT id, action, activity_id, timestamp, attempts FROM events '
+            'WHERE state = ? ORDER BY id LIMIT 1', (self.PENDING,)).fetchone()
+        return JournalEvent(*row) if row else None
+
+    def pending_count(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM events WHERE state = ?',
+                                    (self.PENDING,)).fetchone()[0]
+
+    def claim(self, event):
+        """
+        Counts a send attempt of `event`. Returns False if the entry was
+        merged with a later switch since it was read.
+        """
+        with self._lock:
+            return self._db.execute(
+                'UPDATE events SET attempts = attempts + 1 '
+                'WHERE id = ? AND activity_id = ? AND state = ?',
+                (event.id, event.activity_id, self.PENDING)).rowcount == 1
+
+    def mark(self, event_id, state, response=None):
+        with self._lock:
+            self._db.execute('UPDATE events SET state = ?, response = ? WHERE id = ?',
+                             (state, response, event_id))
+
+    def wait(self, timeout):
+        """
+        Waits up to `timeout` seconds for the journal to change.
+        """
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def wake(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def _seconds_between(start, stop):
+    return abs(_seconds_since(start, stop))
+
+def _seconds_since(start, stop):
+    fmt = '%Y-%m-%dT%H:%M:%S.%f'
+    return (datetime.strptime(stop, fmt) - datetime.strptime(start, fmt)).total_seconds()
+
+class JournalReplayer(threading.Thread):
+    """
+    Background thread sending the journal entries to the API in order.
+
+    An entry is only marked as done after the API accepted it. Entries that
+    were already sent once without a known outcome are checked against the
+    current tracking first, so that a replay never starts or stops the same
+    activity twice. Network errors and 5xx/429 answers keep the entry pending
+    and are retried with exponential backoff.
+
+    The last pending start is held until it is `merge_window` seconds old,
+    so that a quick switch can still be merged into it by
+    `TrackingJournal.append_switch` instead of costing a stop and a start.
+    """
+    def __init__(self, journal, client=None, on_result=None, backoff=(1, 60), merge_window=0):
+        """
+        Parameters
+        ----------
+        journal : TrackingJournal
+            The journal to drain
+        client : Timeular
+            API client, it can be set later (or replaced) with `client`
+        on_result : a function
+            Called from this thread with (event, response) after every entry
+        backoff : tuple
+            Minimum and maximum seconds between retries
+        merge_window : float
+            Seconds the last pending start is held, see `append_switch`
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.journal = journal
+        self.client = client
+        self.on_result = on_result
+        self.merge_window = merge_window
+        self._backoff = backoff
+        self._stop_event = threading.Event()
+        self._held = (None, 0)
+
+    def run(self):
+        delay = self._backoff[0]
+        while not self._stop_event.is_set():
+            if self.client is None:
+                self._stop_event.wait(delay)
+                continue
+            event = self.journal.next_pending(timeout=self._backoff[1])
+            if event is None:
+                continue
+            hold = self._hold(event)
+            if hold > 0:
+                # woken up early by an append, which may have merged it
+                self.journal.wait(hold)
+                continue
+            try:
+                done = self.replay(event)
+            except Exception as e:
+                _log.info('journal replay of %s failed: %s' % (event.id, e))
+                done = False
+            if done:
+                delay = self._backoff[0]
+            else:
+                delay = min(delay * 2, self._backoff[1])
+                self._stop_event.wait(delay * random.uniform(0.5, 1))
+
+    def _hold(self, event):
+        """
+        Seconds to wait before sending `event`, 0 if it can be sent now.
+        """
+        if not self.merge_window or event.action != 'start' or event.attempts \
+            or self.journal.pending_count() > 1:
+            return 0
+        if self._held[0] != event.id:
+            self._held = (event.id, time.monotonic())
+        now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')
+        age = _seconds_since(event.timestamp, now)
+        # bounded by the time seen here as well, in case the clock was set back
+        held = time.monotonic() - self._held[1]
+        return min(self.merge_window - age, self.merge_window - held)
+
+    def replay(self, event):
+        """
+        Sends one journal entry. Returns False if it has to be retried.
+        """
+        tracking = self.client.tracking
+        if event.action in ('switch', 'side'):
+            return self._replay_switch(event)
+        if event.attempts and self._already_applied(event):
+            self.journal.mark(event.id, TrackingJournal.DONE)
+            return True
+
+        if not self.journal.claim(event):
+            return True
+        if event.action == 'start':
+            response = tracking.post_start(event.activity_id, started_at=event.timestamp)
+        else:
+            response = tracking.post_stop(event.activity_id, stopped_at=event.timestamp)
+
+        return self._finish(event, response)
+
+    def _finish(self, event, response):
+        if response and "status_code" in response:
+            if response["status_code"] >= 500 or response["status_code"] == 429:
+                return False
+            self.journal.mark(event.id, TrackingJournal.REJECTED, response["message"])
+        else:
+            self.journal.mark(event.id, TrackingJournal.DONE)
+        if self.on_result:
+            self.on_result(event, response)
+        return True
+
+    def _replay_switch(self, event):
+        """
+        Resolves a 'side' to its activity and makes it the tracked one,
+        stopping whatever the server tracks. It is compared with the current
+        tracking first, so it can be replayed again after a failure.
+        """
+        if event.action == 'side':
+            activity = self.client.activities.get_activitity_side(int(event.activity_id))
+            target = str(activity["id"]) if activity else None
+        else:
+            target = event.activity_id or None
+        if not self.journal.claim(event):
+            return True
+        tracking = self.client.tracking
+        current = tracking.current(max_age=0)
+        running = str(current["activity"]["id"]) if current is not None else None
+        response = None
+        if running is not None and running != target:
+            response = tracking.post_stop(running, stopped_at=event.timestamp)
+            if response and "status_code" in response:
+                return self._finish(event, response)
+            running = None
+        if target is not None and running is None:
+            response = tracking.post_start(target, started_at=event.timestamp)
+        return self._finish(event, response)
+
+    def _already_applied(self, event):
+        current = self.client.tracking.get()
+        if "status_code" in current:
+            raise IOError(current["message"])
+        current = current["currentTracking"]
+        running = current is not None and str(current["activity"]["id"]) == event.activity_id
+        if event.action == 'start':
+            return running
+        return not running
+
+    def stop(self):
+        self._stop_event.set()
+        self.journal.wake()
@@ -0,0 +1,116 @@
+import logging
+import threading
+from collections import deque
+
+
+class LogSink():
+    """
+    Destination of the log lines shown to the user. The last `max_lines`
+    are kept in a ring buffer, so the memory stays flat however long the
+    session is. With a Tk widget, the lines written during a frame are
+    inserted with a single update and the widget is trimmed to the same
+    cap. Without Tk (headless mode) they go to a stream, e.g. stdout or
+    a log file.
+    """
+    def __init__(self, max_lines=500, widget=None, root=None, stream=None, frame_ms=33):
+        """
+        Parameters
+        ----------
+        max_lines : int
+            Number of lines kept in the buffer and in the widget
+        widget : tk.Text, optional
+            Text widget displaying the lines, kept disabled between updates
+        root : tk root object, optional
+            Schedules the widget updates, required with `widget`
+        stream : a file object, optional
+            Every line is also written to it
+        frame_ms : int
+            Delay between the first pending line and the widget update
+        """
+        self.widget = widget
+        self.root = root
+        self.stream = stream
+        self.frame_ms = frame_ms
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._lines = deque(maxlen=max_lines)
+        self._pending = deque(maxlen=max_lines)
+        self._flush_job = None
+
+    @property
+    def max_lines(self):
+        return self._lines.maxlen
+
+    def resize(self, max_lines):
+        with self._lock:
+            self._lines = deque(self._lines, maxlen=max_lines)
+            self._pending = deque(self._pending, maxlen=max_lines)
+
+    def write(self, line):
+        """
+        Adds a line. With a widget it must be called on the Tk thread, the
+        other threads go through the message queue.
+        """
+        with self._lock:
+            self._lines.append(line)
+            if self.widget is not None:
+                if len(self._pending) == self._pending.maxlen:
+                    self.dropped += 1
+                self._pending.append(line)
+            if self.stream is not None:
+                self.stream.write(line + '\n')
+                if self.root is None:
+                    self.stream.flush()
+        if self.root is not None and self._flush_job is None:
+            self._flush_job = self.root.after(self.frame_ms, self.flush)
+
+    def lines(self):
+        """
+        The buffered lines, oldest first.
+        """
+        with self._lock:
+            return list(self._lines)
+
+    def flush(self):
+        """
+        Writes the pending lines to the widget and the stream at once.
+        """
+        self._flush_job = None
+        with self._lock:
+            pending = list(self._pending)
+            self._pending.clear()
+            if self.stream is not None:
+                self.stream.flush()
+        if not pending or self.widget is None:
+            return
+        widget = self.widget
+        widget.configure(state='normal')
+        widget.insert('end', '\n'.join(pending) + '\n')
+        # the text always ends with an empty line after the last newline
+        excess = int(widget.index('end-1c').split('.')[0]) - 1 - self.max_lines
+        if excess > 0:
+            widget.delete('1.0', '%d.0' % (excess + 1))
+        widget.see('end')
+        widget.configure(state='disabled')
+
+    def close(self):
+        if self._flush_job is not None:
+            self.root.after_cancel(self._flush_job)
+            self._flush_job = None
+        if self.stream is not None:
+            self.stream.flush()
+
+
+class SinkHandler(logging.Handler):
+    """
+    Logging handler writing the formatted records to a `LogSink`.
+    """
+    def __init__(self, sink, level=logging.NOTSET):
+        super(SinkHandler, self).__init__(level)
+        self.sink = sink
+
+    def emit(self, record):
+        try:
+            self.sink.write(self.format(record))
+        except Exception:
+            self.handleError(record)
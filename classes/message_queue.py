@@ -0,0 +1,94 @@
+import queue
+
+
+class BoundedMessageQueue(queue.Queue):
+    """
+    Message queue between the worker threads and the GUI thread. It never
+    blocks the producer: when it is full, an item is dropped following the
+    overflow policy. `on_put` is called after every put, it is used to wake
+    the consumer up instead of polling.
+
+    Items are tuples whose first element is their kind ('side', 'callback',
+    ...).
+
+    Overflow policies
+    -----------------
+    drop-oldest : the oldest queued item is dropped
+    coalesce : a side only ever replaces an older side, a state change an
+        older state change and a message an older message; the other
+        items push out the oldest message. Sides, callbacks, journal
+        results and state changes are never dropped for another kind:
+        without anything to replace, a new message is discarded and the
+        other items are queued beyond `maxsize`, up to `overflow` more.
+        Past that hard cap, new items are discarded.
+    """
+    DROP_OLDEST = 'drop-oldest'
+    COALESCE = 'coalesce'
+
+    # kind of a new item -> kinds it can replace under coalesce
+    _REPLACES = {'side': ('side',), 'ble_state': ('ble_state',), 'message': ('message',)}
+
+    def __init__(self, maxsize=256, policy=COALESCE, on_put=None, overflow=None):
+        """
+        Parameters
+        ----------
+        maxsize : int
+            Number of items queued before the overflow policy applies
+        policy : string
+            DROP_OLDEST or COALESCE
+        on_put : a function, optional
+            Called after every put
+        overflow : int, optional
+            Items queued beyond `maxsize` when nothing can be replaced,
+            `maxsize` by default
+        """
+        if maxsize <= 0:
+            raise ValueError('maxsize must be positive')
+        if policy not in (self.DROP_OLDEST, self.COALESCE):
+            raise ValueError('unknown overflow policy: %s' % policy)
+        queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.on_put = on_put
+        self.overflow = maxsize if overflow is None else overflow
+        self.dropped = 0
+
+    def put(self, item, block=False, timeout=None):
+        with self.not_full:
+            if self._qsize() >= self.maxsize and not self._drop_for(item):
+                self.dropped += 1
+                return
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        if self.on_put is not None:
+            self.on_put()
+
+    def _drop_for(self, item):
+        """
+        Makes room for `item`, returns False if `item` itself is dropped.
+        """
+        if self.policy == self.COALESCE:
+            kind = self._kind(item)
+            for victim in self._REPLACES.get(kind, ('message',)):
+                index = self._find(victim)
+                if index is not None:
+                    break
+            else:
+                # nothing to replace, only the hard cap bounds the queue
+                return kind != 'message' and self._qsize() < self.maxsize + self.overflow
+            del self.queue[index]
+        else:
+            self.queue.popleft()
+        self.unfinished_tasks -= 1
+        self.dropped += 1
+        return True
+
+    def _find(self, kind):
+        for index, queued in enumerate(self.queue):
+            if self._kind(queued) == kind:
+                return index
+        return None
+
+    @staticmethod
+    def _kind(item):
+        return item[0] if isinstance(item, tuple) and item else None
@@ -0,0 +1,198 @@
+import select
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from bluepy import btle
+
+from classes.bluetooth_backend import Zei, Backoff, BluetoothBackend
+from classes.gatt_cache import GattHandleCache
+
+import logging
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.StreamHandler())
+_log.setLevel(logging.NOTSET)
+
+TrackerConfig = namedtuple('TrackerConfig', ['address', 'api_key', 'api_secret', 'activities'])
+TrackerConfig.__doc__ = """
+A ZEI and the Timeular account it tracks for. `activities` optionally maps
+device sides to activity ids, overriding the sides set in the account.
+"""
+
+def read_trackers(data):
+    """
+    Reads the trackers from the settings in data.json. Besides the single
+    'device_mac', a list of trackers can be given, each one with its own
+    account, falling back to the top level 'apiKey'/'apiSecret':
+
+        "trackers": [{"device_mac": "...", "apiKey": "...", "apiSecret": "...",
+                      "activities": {"1": "<activity id>"}}]
+    """
+    trackers = []
+    for tracker in data.get('trackers', []):
+        activities = {int(side): activity_id
+                      for side, activity_id in tracker.get('activities', {}).items()}
+        trackers.append(TrackerConfig(tracker['device_mac'].lower(),
+                                      tracker.get('apiKey', data.get('apiKey', '')),
+                                      tracker.get('apiSecret', data.get('apiSecret', '')),
+                                      activities))
+    if not trackers and data.get('device_mac'):
+        trackers.append(TrackerConfig(data['device_mac'].lower(),
+                                      data.get('apiKey', ''), data.get('apiSecret', ''), {}))
+    return trackers
+
+
+class ZeiMultiplexer():
+    """
+    Serves many ZEI from one thread. It selects on the file descriptors of
+    the bluepy helpers and only reads from the trackers with pending data,
+    so an idle room costs no CPU. Connections are opened by a small pool in
+    the background and handed over to the loop, a tracker that is down
+    never delays the notifications of the others.
+    """
+    def __init__(self, on_notification, on_state=None, handle_cache=None, connect_workers=4):
+        """
+        Parameters
+        ----------
+        on_notification : a function
+            Called on the loop thread with (address, event), see `NotificationDecoder`
+        on_state : a function, optional
+            Called with (address, state) on every connection state change
+        handle_cache : GattHandleCache, optional
+            GATT handles shared by all the trackers
+        connect_workers : int
+            Number of connections opened at the same time
+        """
+        self.on_notification = on_notification
+        self.on_state = on_state
+        self.handle_cache = handle_cache or GattHandleCache()
+        self._connector = ThreadPoolExecutor(max_workers=connect_workers,
+                                             thread_name_prefix='zei-connect')
+        self._lock = threading.Lock()
+        self._connected = {}
+        self._connecting = set()
+        self._retry_at = {}
+        self._backoff = {}
+        self._stop = threading.Event()
+
+    def add(self, address):
+        address = address.lower()
+        with self._lock:
+            self._backoff.setdefault(address, Backoff(1.0, 60.0))
+            self._retry_at.setdefault(address, 0)
+
+    def remove(self, address):
+        address = address.lower()
+        with self._lock:
+            self._backoff.pop(address, None)
+            self._retry_at.pop(address, None)
+            zei = self._connected.pop(address, None)
+        if zei is not None:
+            self._disconnect(address, zei)
+
+    def addresses(self):
+        with self._lock:
+            return list(self._backoff)
+
+    def _set_state(self, address, state):
+        if self.on_state is not None:
+            self.on_state(address, state)
+
+    def _connect(self, address):
+        self._set_state(address, BluetoothBackend.CONNECTING)
+        try:
+            zei = Zei(address, 'random', iface=0, handle_cache=self.handle_cache)
+            zei.set_handler(lambda event: self.on_notification(address, event))
+        except Exception as e:
+            _log.info('[%s] connection failed: %s', address, e)
+            with self._lock:
+                self._connecting.discard(address)
+                if address in self._backoff:
+                    self._retry_at[address] = time.monotonic() + self._backoff[address].next()
+            self._set_state(address, BluetoothBackend.DISCONNECTED)
+            return
+        with self._lock:
+            self._connecting.discard(address)
+            if address not in self._backoff:
+                removed = True
+            else:
+                removed = False
+                self._backoff[address].reset()
+                self._connected[address] = zei
+        if removed:
+            self._disconnect(address, zei)
+        else:
+            self._set_state(address, BluetoothBackend.SUBSCRIBED)
+
+    def _disconnect(self, address, zei):
+        try:
+            zei.disconnect()
+        except btle.BTLEException:
+            pass
+        self._set_state(address, BluetoothBackend.DISCONNECTED)
+
+    def _lost(self, address):
+        with self._lock:
+            zei = self._connected.pop(address, None)
+            if address in self._backoff:
+                self._retry_at[address] = time.monotonic() + self._backoff[address].next()
+        if zei is not None:
+            self._disconnect(address, zei)
+
+    def _start_connections(self):
+        """
+        Submits the due reconnections, returns the seconds until the next one.
+        """
+        now = time.monotonic()
+        next_retry = None
+        with self._lock:
+            for address, retry_at in self._retry_at.items():
+                if address in self._connected or address in self._connecting:
+                    continue
+                if retry_at <= now:
+                    self._connecting.add(address)
+                    self._connector.submit(self._connect, address)
+                elif next_retry is None or retry_at - now < next_retry:
+                    next_retry = retry_at - now
+        return next_retry
+
+    def run(self, poll_interval=1.0):
+        """
+        Loops until `stop` is called. `poll_interval` bounds how long a new
+        connection waits before its notifications are selected.
+        """
+        while not self._stop.is_set():
+            next_retry = self._start_connections()
+            timeout = poll_interval if next_retry is None else min(poll_interval, next_retry)
+            with self._lock:
+                descriptors = {zei._helper.stdout.fileno(): (address, zei)
+                               for address, zei in self._connected.items()
+                               if zei._helper is not None}
+            if not descriptors:
+                self._stop.wait(timeout)
+                continue
+            # the lines read ahead are invisible to select, don't wait on them
+            buffered = [descriptor for descriptor, (_, zei) in descriptors.items()
+                        if zei.has_buffered()]
+            ready, _, _ = select.select(list(descriptors), [], [], 0 if buffered else timeout)
+            for descriptor in set(ready).union(buffered):
+                address, zei = descriptors[descriptor]
+                try:
+                    # a positive timeout makes bluepy poll the descriptor before
+                    # reading a chunk, 0 reads the buffered lines without blocking
+                    if descriptor in ready:
+                        zei.waitForNotifications(0.001)
+                    while zei.has_buffered():
+                        zei.waitForNotifications(0)
+                except btle.BTLEException as e:
+                    _log.info('[%s] connection lost: %s', address, e)
+                    self._lost(address)
+        with self._lock:
+            connected, self._connected = self._connected, {}
+        for address, zei in connected.items():
+            self._disconnect(address, zei)
+        self._connector.shutdown(wait=False)
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,152 @@
+"""
+Local reports over time entries, computed with NumPy instead of a
+/report round trip per view.
+"""
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+
+class ReportEngine():
+    """
+    Aggregates time entries held as arrays of start/stop epochs and of
+    activity and tag codes. Entries crossing midnight are split at the local
+    midnights of `timezone`, DST changes included.
+    """
+    def __init__(self, entries, timezone='Europe/Paris'):
+        """
+        Parameters
+        ----------
+        entries : iterable of dict
+            Time entries as returned by the API or `TimeEntryStore.query`
+        timezone : string
+            IANA name of the timezone of the days and weeks
+        """
+        self.timezone = ZoneInfo(timezone)
+        starts, stops, activities, tag_entries, tags = [], [], [], [], []
+        self.activity_ids = []
+        self.tag_keys = []
+        activity_codes, tag_codes = {}, {}
+        for index, entry in enumerate(entries):
+            starts.append(entry["duration"]["startedAt"])
+            stops.append(entry["duration"]["stoppedAt"])
+            activity_id = (entry.get("activity") or {}).get("id") or entry.get("activityId")
+            if activity_id not in activity_codes:
+                activity_codes[activity_id] = len(self.activity_ids)
+                self.activity_ids.append(activity_id)
+            activities.append(activity_codes[activity_id])
+            note = entry.get("note") or {}
+            for tag in (note.get("tags") or []) + (note.get("mentions") or []):
+                key = tag["key"]
+                if key not in tag_codes:
+                    tag_codes[key] = len(self.tag_keys)
+                    self.tag_keys.append(key)
+                tag_entries.append(index)
+                tags.append(tag_codes[key])
+
+        # the API timestamps are UTC ISO 8601, numpy parses them at once
+        self.starts = np.array(starts, dtype='datetime64[ms]').astype(np.int64) / 1000.0
+        self.stops = np.array(stops, dtype='datetime64[ms]').astype(np.int64) / 1000.0
+        self.activities = np.array(activities, dtype=np.int32)
+        self.tag_entries = np.array(tag_entries, dtype=np.int64)
+        self.tags = np.array(tags, dtype=np.int32)
+
+    @classmethod
+    def from_store(cls, store, stopped_after, started_before, timezone='Europe/Paris'):
+        return cls(store.query(stopped_after, started_before), timezone)
+
+    def _clip(self, start=None, stop=None):
+        # start and stop are timezone aware datetimes
+        starts, stops = self.starts, self.stops
+        if start is not None:
+            starts = np.maximum(starts, start.timestamp())
+        if stop is not None:
+            stops = np.minimum(stops, stop.timestamp())
+        return starts, np.maximum(stops, starts)
+
+    def _midnights(self, starts, stops):
+        """
+        Epochs of the local midnights around the entries, and their dates.
+        """
+        first = datetime.fromtimestamp(starts.min(), self.timezone).date()
+        last = datetime.fromtimestamp(stops.max(), self.timezone).date() + timedelta(days=1)
+        dates = [first + timedelta(days=day) for day in range((last - first).days + 1)]
+        midnights = np.array([datetime(date.year, date.month, date.day, tzinfo=self.timezone)
+                              .timestamp() for date in dates])
+        return midnights, dates
+
+    def _split_days(self, start=None, stop=None):
+        """
+        Splits the entries at midnight.
+
+        Returns
+        -------
+        entries, days, seconds : arrays
+            One row per piece: index of its entry, of its day, and duration
+        dates : list of date
+            The date of every day index
+        """
+        starts, stops = self._clip(start, stop)
+        if not len(starts):
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0), []
+        midnights, dates = self._midnights(starts, stops)
+        first_day = np.searchsorted(midnights, starts, side='right') - 1
+        last_day = np.searchsorted(midnights, stops, side='left') - 1
+        last_day = np.maximum(last_day, first_day)
+        pieces = last_day - first_day + 1
+
+        entries = np.repeat(np.arange(len(starts)), pieces)
+        offsets = np.arange(len(entries)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        days = first_day[entries] + offsets
+        seconds = np.minimum(stops[entries], midnights[days + 1]) - \
+            np.maximum(starts[entries], midnights[days])
+        return entries, days, np.maximum(seconds, 0), dates
+
+    def by_activity(self, start=None, stop=None):
+        """
+        Total seconds per activity id.
+        """
+        starts, stops = self._clip(start, stop)
+        totals = np.bincount(self.activities, weights=stops - starts,
+                             minlength=len(self.activity_ids))
+        return {self.activity_ids[code]: float(total)
+                for code, total in enumerate(totals) if total}
+
+    def by_tag(self, start=None, stop=None):
+        """
+        Total seconds per tag/mention key.
+        """
+        starts, stops = self._clip(start, stop)
+        durations = (stops - starts)[self.tag_entries]
+        totals = np.bincount(self.tags, weights=durations, minlength=len(self.tag_keys))
+        return {self.tag_keys[code]: float(total)
+                for code, total in enumerate(totals) if total}
+
+    def by_day(self, start=None, stop=None):
+        """
+        Seconds per local date and activity id: {date: {activity_id: seconds}}.
+        """
+        entries, days, seconds, dates = self._split_days(start, stop)
+        return self._grouped(days, self.activities[entries], seconds, dates)
+
+    def by_week(self, start=None, stop=None):
+        """
+        Seconds per ISO week, keyed by the date of its Monday, and activity id.
+        """
+        entries, days, seconds, dates = self._split_days(start, stop)
+        if not dates:
+            return {}
+        first_monday = dates[0] - timedelta(days=dates[0].weekday())
+        weeks = (np.arange(len(dates)) + dates[0].weekday()) // 7
+        mondays = [first_monday + timedelta(weeks=week) for week in range(weeks[-1] + 1)]
+        return self._grouped(weeks[days], self.activities[entries], seconds, mondays)
+
+    def _grouped(self, groups, activities, seconds, labels):
+        width = len(self.activity_ids)
+        totals = np.bincount(groups * width + activities, weights=seconds,
+                             minlength=len(labels) * width).reshape(len(labels), width)
+        result = {}
+        for group, code in zip(*np.nonzero(totals)):
+            result.setdefault(labels[group], {})[self.activity_ids[code]] = float(totals[group, code])
+        return result
@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'etag', 'last_modified', 'stored_at'])
+
+
+class ResponseCache():
+    """
+    In-memory cache of the decoded bodies of GET responses, keyed by URL.
+    Every route has a freshness: while an entry is younger than it, it is
+    returned without a request, once it is older it is revalidated with
+    If-None-Match / If-Modified-Since and a 304 returns it again without
+    decoding any JSON. The least recently used entries are evicted first.
+
+    The bodies are shared between the callers, they must not be modified.
+    """
+    # seconds an entry is used without revalidation, by resource prefix.
+    # 0 always revalidates, resources missing here aren't cached at all
+    # (time entries and reports are large and rarely read twice).
+    DEFAULT_POLICY = {
+        '/activities': 60,
+        '/tags-and-mentions': 60,
+        '/devices': 60,
+        '/tracking': 0,
+        '/user/profile': 3600,
+        '/integrations': 3600,
+    }
+
+    def __init__(self, max_entries=128, policy=None):
+        """
+        Parameters
+        ----------
+        max_entries : int
+            Number of responses kept, 0 disables the cache
+        policy : dict, optional
+            Resource prefix -> freshness in seconds, replacing DEFAULT_POLICY
+        """
+        self.max_entries = max_entries
+        self.policy = dict(self.DEFAULT_POLICY if policy is None else policy)
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def max_age(self, resource):
+        """
+        Freshness of the resource (e.g. '/activities/archived') given by its
+        longest matching prefix, None if it isn't cached.
+        """
+        if not self.max_entries:
+            return None
+        best = None
+        for prefix in self.policy:
+            if (resource == prefix or resource.startswith(prefix + '/')) and \
+                    (best is None or len(prefix) > len(best)):
+                best = prefix
+        return None if best is None else self.policy[best]
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def is_fresh(self, entry, max_age, now=None):
+        if now is None:
+            now = time.monotonic()
+        return now - entry.stored_at < max_age
+
+    def validators(self, entry):
+        """
+        Conditional request headers revalidating `entry`.
+        """
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def store(self, url, body, headers):
+        """
+        Stores the decoded `body` of a 2xx response with its validators.
+        """
+        if 'no-store' in headers.get('Cache-Control', ''):
+            return
+        entry = CacheEntry(body, headers.get('ETag'), headers.get('Last-Modified'),
+                           time.monotonic())
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def touch(self, url):
+        """
+        Restarts the freshness of an entry revalidated by a 304.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries[url] = entry._replace(stored_at=time.monotonic())
+                self._entries.move_to_end(url)
+            return entry
+
+    def invalidate(self, prefix=''):
+        """
+        Drops the entries whose URL starts with `prefix`, all of them by default.
+        """
+        with self._lock:
+            for url in [url for url in self._entries if url.startswith(prefix)]:
+                del self._entries[url]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,19 @@
+"""
+Startup milestones for the cold start benchmark (benchmarks/bench_startup.py).
+With TIMEULAR_STARTUP_BENCH set, every milestone is printed once on stderr
+as a JSON line with its epoch time; otherwise `mark` does nothing.
+"""
+import os
+import sys
+import time
+
+ENABLED = bool(os.environ.get('TIMEULAR_STARTUP_BENCH'))
+_marked = set()
+
+
+def mark(milestone):
+    if not ENABLED or milestone in _marked:
+        return
+    _marked.add(milestone)
+    sys.stderr.write('{"startup": "%s", "time": %.6f}\n' % (milestone, time.time()))
+    sys.stderr.flush()
@@ -0,0 +1,54 @@
+import re
+
+
+class TagParser():
+    """
+    Extracts the #tags and @mentions of a note with a precompiled pattern
+    and resolves their labels through hash indexes, built from the
+    response of `TagMentions.get`.
+    """
+    _PATTERN = re.compile(r'([#@])([^\s#@]+)')
+    _KINDS = {'#': 'tags', '@': 'mentions'}
+
+    def __init__(self, tags_and_mentions=None):
+        self.keys = {'tags': {}, 'mentions': {}}
+        if tags_and_mentions:
+            self.update(tags_and_mentions)
+
+    def update(self, tags_and_mentions):
+        """
+        Rebuilds the label -> key indexes from a `TagMentions.get` response.
+        """
+        if not tags_and_mentions or "status_code" in tags_and_mentions:
+            return
+        self.keys = {kind: {item["label"]: item["key"]
+                            for item in tags_and_mentions.get(kind) or []}
+                     for kind in ('tags', 'mentions')}
+
+    def get_key(self, label, kind='tags'):
+        return self.keys[kind].get(label)
+
+    def parse(self, text):
+        """
+        Returns the text without the '#'/'@' of its tags and mentions, and
+        the tags and mentions found, in the format of a tracking note:
+        {'indices': [start, end], 'key': key}, `end` being exclusive and
+        both indices pointing into the returned text. Labels unknown to the
+        account are left as plain text.
+        """
+        found = {'tags': [], 'mentions': []}
+        pieces = []
+        position = 0
+        removed = 0
+        for match in self._PATTERN.finditer(text):
+            kind = self._KINDS[match.group(1)]
+            key = self.keys[kind].get(match.group(2))
+            if key is None:
+                continue
+            pieces.append(text[position:match.start()])
+            position = match.start() + 1
+            start = match.start() - removed
+            removed += 1
+            found[kind].append({'indices': [start, start + len(match.group(2))], 'key': key})
+        pieces.append(text[position:])
+        return ''.join(pieces), found['tags'], found['mentions']
@@ -3,6 +3,8 @@ import threading
 import queue
 import sys
 from classes.bluetooth_gui import BluetoothChatGUI
+from classes.message_queue import BoundedMessageQueue
+from classes.framing import FrameDecoder
 
 class ThreadedClient():
     def __init__(self, root):
@@ -16,7 +18,7 @@ class ThreadedClient():
             This is the passed along tk root thing
         """
         self.root = root
-        self.message_queue = queue.Queue()
+        self.message_queue = BoundedMessageQueue(maxsize=256, on_put=self.wake_gui)
 
         self.thread_stop = threading.Event()
         self.running = True
@@ -28,7 +30,8 @@ class ThreadedClient():
                                 self.end_gui, 
                                 self.start_message_awaiting,
                                 self.end_bluetooth_connection)
-        self.periodic_call()
+        self.root.bind('<<MessageQueue>>', self.process_messages)
+        self.process_messages()
 
     def start_message_awaiting(self):
         """
@@ -52,55 +55,47 @@ class ThreadedClient():
         except Exception as e:
             print(e)
 
-    def periodic_call(self):
+    def wake_gui(self):
         """
-        This is the function which as its name suggest, periodicly call
-        the GUI thread to see if there are any new messages.
+        Called by the producers after every put, it schedules
+        `process_messages` on the Tk thread. The main loop sleeps otherwise.
         """
-        self.gui.check_message_queue()
-        if not self.running:
-            self.stop_threads()
-        else:
-            self.root.after(100, self.periodic_call)
+        try:
+            self.root.event_generate('<<MessageQueue>>', when='tail')
+        except (tk.TclError, RuntimeError):
+            # the window is being destroyed
+            pass
 
-    def get_complete_message(self):
+    def process_messages(self, event=None):
         """
-        While our bluetooth connection is ongoing, receive each message and
-        if there is no '\n' delimiter, gradually peice the entire message together and
-        return it.
-
-        Returns
-        -------
-        message_buffer : byte string
-            The full message data pieced together
+        Lets the GUI handle every queued message, it runs on the Tk thread
+        whenever a producer woke it up.
         """
-        try:
-            more_data = True
-            message_buffer = b''
-            while more_data:
-                data = self.gui.sock.recv(8192)
-                if '\n'.encode('ascii') in data:
-                    more_data = False
-                    message_buffer += data.strip('\n'.encode('ascii'))
-                else:
-                    message_buffer += data
-            return message_buffer
-        except Exception:
-            self.connection_running = False
+        self.gui.check_message_queue()
+        if not self.running:
+            self.stop_threads()
 
     def await_messages_thread(self):
         """
-        While our bluetooth connection is ongoing, gather all complete messages received
-        and place them into our message queue.
+        While our bluetooth connection is ongoing, receive the data straight
+        into the frame decoder and place every complete message, split on
+        the '\n' delimiter, into our message queue.
         """
+        decoder = FrameDecoder(delimiter='\n'.encode('ascii'))
         while self.connection_running:
-            message = self.get_complete_message()
+            try:
+                received = decoder.recv_into(self.gui.sock)
+            except Exception:
+                received = 0
+            if not received:
+                self.connection_running = False
             if not self.connection_running:
                 break
-            try:
-                self.message_queue.put(message)
-            except AttributeError:
-                pass
+            for message in decoder.frames():
+                try:
+                    self.message_queue.put(('frame', message))
+                except AttributeError:
+                    pass
 
     def end_gui(self):
         """
@@ -108,6 +103,7 @@ class ThreadedClient():
         the application
         """
         self.running = False
+        self.wake_gui()
 
     def end_bluetooth_connection(self):
         """
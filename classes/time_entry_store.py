@@ -0,0 +1,137 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+from .timeular import format_time, parse_time
+
+
+class TimeEntryStore():
+    """
+    Local SQLite copy of the time entries, indexed by start, activity and
+    tag/mention, so that reports and analyses run offline. `sync` only
+    fetches what changed since the previous one (its high-water mark); set
+    the store on `Timeular.time_entries.store` to apply the local post,
+    patch and delete calls as well.
+    """
+    def __init__(self, path='time_entries.db'):
+        """
+        Parameters
+        ----------
+        path : string
+            Location of the SQLite database, created if it doesn't exist
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                id TEXT PRIMARY KEY,
+                activity_id TEXT,
+                started_at TEXT NOT NULL,
+                stopped_at TEXT NOT NULL,
+                data TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS entries_started_at ON entries (started_at);
+            CREATE INDEX IF NOT EXISTS entries_stopped_at ON entries (stopped_at);
+            CREATE INDEX IF NOT EXISTS entries_activity ON entries (activity_id, started_at);
+            CREATE TABLE IF NOT EXISTS entry_tags (
+                entry_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS entry_tags_key ON entry_tags (key, kind);
+            CREATE INDEX IF NOT EXISTS entry_tags_entry ON entry_tags (entry_id);
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value TEXT);''')
+
+    def upsert(self, entries):
+        """
+        Inserts or replaces time entries as returned by the API.
+        """
+        with self._lock, self._db:
+            for entry in entries:
+                self._upsert(entry)
+
+    def _upsert(self, entry):
+        entry_id = str(entry["id"])
+        activity = entry.get("activity") or {}
+        self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                         (entry_id, activity.get("id") or entry.get("activityId"),
+                          entry["duration"]["startedAt"], entry["duration"]["stoppedAt"],
+                          json.dumps(entry)))
+        self._db.execute('DELETE FROM entry_tags WHERE entry_id = ?', (entry_id,))
+        note = entry.get("note") or {}
+        for kind in ("tags", "mentions"):
+            for tag in note.get(kind) or []:
+                self._db.execute('INSERT INTO entry_tags VALUES (?, ?, ?)',
+                                 (entry_id, kind, str(tag["key"])))
+
+    def delete(self, entry_id):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM entries WHERE id = ?', (str(entry_id),))
+            self._db.execute('DELETE FROM entry_tags WHERE entry_id = ?', (str(entry_id),))
+
+    @property
+    def high_water_mark(self):
+        """
+        Time up to which the store is in sync with the API, None before the
+        first sync.
+        """
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'high_water_mark'").fetchone()
+        return row[0] if row else None
+
+    def sync(self, time_entries, since, overlap=timedelta(days=2), window=timedelta(days=7),
+             max_workers=4):
+        """
+        Fetches the entries changed since the high-water mark, `since` is the
+        start of the history on the first sync. The last `overlap` before
+        the mark is fetched again to pick up entries edited after they were
+        synced; local entries of that range missing in the API are deleted.
+
+        Returns
+        -------
+        count : int
+            Number of entries fetched
+        """
+        now = datetime.utcnow()
+        mark = self.high_water_mark
+        start = parse_time(mark) - overlap if mark else \
+            (parse_time(since) if isinstance(since, str) else since)
+        fetched = list(time_entries.iter_range(start, now, window=window,
+                                               max_workers=max_workers))
+        with self._lock, self._db:
+            returned = set(str(entry["id"]) for entry in fetched)
+            stale = [row[0] for row in self._db.execute(
+                'SELECT id FROM entries WHERE stopped_at > ? AND started_at < ?',
+                (format_time(start), format_time(now)))
+                if row[0] not in returned]
+            for entry_id in stale:
+                self._db.execute('DELETE FROM entries WHERE id = ?', (entry_id,))
+                self._db.execute('DELETE FROM entry_tags WHERE entry_id = ?', (entry_id,))
+            for entry in fetched:
+                self._upsert(entry)
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('high_water_mark', ?)",
+                             (format_time(now),))
+        return len(fetched)
+
+    def query(self, stopped_after, started_before, activity_id=None, tag=None):
+        """
+        Entries overlapping the range, sorted by start, optionally only the
+        ones of an activity or with a tag/mention key.
+        """
+        sql = 'SELECT data FROM entries WHERE started_at < ? AND stopped_at > ?'
+        parameters = [started_before, stopped_after]
+        if activity_id is not None:
+            sql += ' AND activity_id = ?'
+            parameters.append(str(activity_id))
+        if tag is not None:
+            sql += ' AND id IN (SELECT entry_id FROM entry_tags WHERE key = ?)'
+            parameters.append(str(tag))
+        sql += ' ORDER BY started_at'
+        with self._lock:
+            return [json.loads(row[0]) for row in self._db.execute(sql, parameters)]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -4,10 +4,17 @@
 taken from https://github.com/Ankirama/python-timeular
 """
 
-import requests
 import json
+import base64
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from .tags import TagParser
+from .response_cache import ResponseCache
 
 import logging
 _log = logging.getLogger(__name__)
@@ -24,8 +31,78 @@ def check_token(f):
 
     return wrapper
 
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
 def get_current_time():
-    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+    return format_time(datetime.utcnow())
+
+def format_time(moment):
+    return moment.strftime(TIME_FORMAT)[:-3]
+
+def parse_time(timestamp):
+    return datetime.strptime(timestamp, TIME_FORMAT)
+
+class HTTPSession(object):
+    """
+    Keep-alive connection pool shared by the Timeular API clients, so that
+    consecutive calls reuse the same TCP/TLS connection instead of
+    handshaking on every request.
+    """
+    def __init__(self, pool_size=4, timeout=(3.05, 10), max_retries=0, health_window=10,
+                 cache_size=128):
+        """
+        Parameters
+        ----------
+        pool_size : int
+            Number of connections kept alive per host
+        timeout : float or tuple
+            Default (connect, read) timeout in seconds for every request
+        max_retries : int
+            Retries on connection errors, passed to the transport adapter
+        health_window : int
+            Number of recent request outcomes used by `is_healthy`
+        cache_size : int
+            Number of GET responses kept by `cache`, 0 disables it
+        """
+        # requests is only loaded once a client is created, not at startup
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.RequestException = requests.RequestException
+        self.timeout = timeout
+        self._outcomes = deque(maxlen=health_window)
+        self.cache = ResponseCache(cache_size)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size,
+                              max_retries=max_retries)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.headers.update({'Connection': 'keep-alive'})
+
+    def request(self, method, url, json_data=None, headers=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            response = self._session.request(method, url, json=json_data,
+                                             headers=headers, timeout=timeout)
+        except self.RequestException:
+            self._outcomes.append(False)
+            raise
+        self._outcomes.append(response.status_code < 500)
+        return response
+
+    def is_healthy(self):
+        """
+        True if the most recent request reached the API and the majority of
+        the recent ones did as well.
+        """
+        if not self._outcomes:
+            return False
+        return self._outcomes[-1] and \
+            sum(self._outcomes) * 2 > len(self._outcomes)
+
+    def close(self):
+        self._session.close()
 
 class API(object):
     _METHODS = ['get', 'post', 'patch', 'delete']
@@ -33,21 +110,42 @@ class API(object):
 
     _access_token = None
     _base_url = None
+    _session = None
 
-    def __init__(self, base_url, access_token=None):
+    def __init__(self, base_url, access_token=None, session=None):
         self._base_url = base_url
         self._access_token = access_token
+        self._session = session if session is not None else HTTPSession()
     
-    def _make_response(self, route='', method='get', json_data={}, need_auth=True, headers={}):
+    def _make_response(self, route='', method='get', json_data={}, need_auth=True, headers={}, timeout=None):
         if method not in self._METHODS:
             _log.info('[%s] is not allowed' % method)
             return False
         url = self._base_url + route
         
+        headers = dict(headers)
         if need_auth:
             headers['Authorization'] = 'Bearer ' + self._access_token
 
-        response = getattr(requests, method)(url, json=json_data, headers=headers)
+        cache = self._session.cache
+        cached = max_age = None
+        if method == 'get':
+            max_age = cache.max_age(getattr(self, '_BASE_URL', '') + route)
+            if max_age is not None:
+                cached = cache.get(url)
+            if cached is not None:
+                if cache.is_fresh(cached, max_age):
+                    cache.hits += 1
+                    return cached.body
+                headers.update(cache.validators(cached))
+
+        response = self._session.request(method, url, json_data=json_data,
+                                         headers=headers, timeout=timeout)
+
+        if response.status_code == 304 and cached is not None:
+            cache.revalidated += 1
+            cache.touch(url)
+            return cached.body
 
         if response.status_code < self._CLASS_STATUS_CODES[0] or \
             response.status_code > self._CLASS_STATUS_CODES[1]:
@@ -55,7 +153,92 @@ class API(object):
             _log.info('[%s]: %s' % (url, response.text))
             return {"status_code": response.status_code, "message": response.text}
 
-        return response.json()
+        if method != 'get':
+            # a write makes every cached read of the resource stale
+            cache.invalidate(self._base_url)
+            return response.json()
+
+        result = response.json()
+        if max_age is not None:
+            cache.misses += 1
+            cache.store(url, result, response.headers)
+        return result
+
+class TokenManager(object):
+    """
+    Caches the access token of a `Timeular` client and signs in again shortly
+    before it expires, pushing the new token to every sub-client at once.
+    """
+    def __init__(self, client, refresh_margin=300, default_lifetime=3600, retry_interval=30):
+        """
+        Parameters
+        ----------
+        client : Timeular
+            The client whose token is managed
+        refresh_margin : int
+            Seconds before the expiry at which the token is renewed
+        default_lifetime : int
+            Lifetime assumed for tokens without an `exp` claim
+        retry_interval : int
+            Seconds to wait before retrying a failed refresh
+        """
+        self._client = client
+        self._refresh_margin = refresh_margin
+        self._default_lifetime = default_lifetime
+        self._retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._timer = None
+        self.expires_at = None
+
+    @staticmethod
+    def get_token_expiry(token):
+        """
+        Returns the `exp` claim of a JWT as epoch seconds, None if the token
+        cannot be decoded.
+        """
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+        except Exception:
+            return None
+
+    def set_token(self, token):
+        with self._lock:
+            self.expires_at = self.get_token_expiry(token) or \
+                time.time() + self._default_lifetime
+            self._client.set_access_token(token)
+        self._schedule(self.expires_at - self._refresh_margin - time.time())
+
+    def refresh(self):
+        result = self._client.get_access_token()
+        if result:
+            self.set_token(result['token'])
+        else:
+            _log.info('token refresh failed, retrying in %ds' % self._retry_interval)
+            self._schedule(self._retry_interval)
+        return result
+
+    def is_expired(self):
+        return self.expires_at is None or time.time() >= self.expires_at
+
+    def _schedule(self, delay):
+        self.cancel()
+        self._timer = threading.Timer(max(delay, 0), self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            _log.info('token refresh failed: %s' % e)
+            self._schedule(self._retry_interval)
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
 
 class Timeular(API):
     activities = None
@@ -67,17 +250,37 @@ class Timeular(API):
     _api_key = None
     _api_secret = None
 
-    def __init__(self, api_key='', api_secret='', base_url='https://api.timeular.com/api/v2'):
-        super(Timeular, self).__init__(base_url)
+    def __init__(self, api_key='', api_secret='', base_url='https://api.timeular.com/api/v2',
+                 pool_size=4, timeout=(3.05, 10)):
+        super(Timeular, self).__init__(base_url,
+                                       session=HTTPSession(pool_size=pool_size, timeout=timeout))
         self._api_key = api_key
         self._api_secret = api_secret
         if not self.get_access_token():
             raise ValueError('Check base_url and the route to get your access token')
-        self.activities = Activities(base_url, self._access_token)
-        self.devices = Devices(base_url, self._access_token)
-        self.tracking = Tracking(base_url, self._access_token)
-        self.time_entries = TimeEntries(base_url, self._access_token)
-        self.tags_and_mentions = TagMentions(base_url, self._access_token)
+        self.activities = Activities(base_url, self._access_token, self._session)
+        self.devices = Devices(base_url, self._access_token, self._session)
+        self.tracking = Tracking(base_url, self._access_token, self._session)
+        self.time_entries = TimeEntries(base_url, self._access_token, self._session)
+        self.tags_and_mentions = TagMentions(base_url, self._access_token, self._session)
+        self.token_manager = TokenManager(self)
+        self.token_manager.set_token(self._access_token)
+
+    def close(self):
+        self.token_manager.cancel()
+        self._session.close()
+
+    def set_access_token(self, access_token):
+        self._access_token = access_token
+        for client in (self.activities, self.devices, self.tracking,
+                       self.time_entries, self.tags_and_mentions):
+            client._access_token = access_token
+
+    def is_connected(self):
+        """
+        Connectivity as seen by the recent requests, it doesn't sign in.
+        """
+        return self._session.is_healthy() and not self.token_manager.is_expired()
 
     def set_api_key(self, api_key):
         self._api_key = api_key
@@ -111,62 +314,159 @@ class Timeular(API):
 
 
 class TagMentions(API):
+    """
+    Every `get` refreshes `parser`, the label -> key index used to extract
+    the tags and mentions of a note.
+    """
     _BASE_URL = '/tags-and-mentions'
 
-    def __init__(self, base_url, access_token):
-        super(TagMentions, self).__init__(base_url + self._BASE_URL, access_token)
+    def __init__(self, base_url, access_token, session=None):
+        super(TagMentions, self).__init__(base_url + self._BASE_URL, access_token, session)
+        self.parser = TagParser()
     
     @check_token
     def get(self):
-        return self._make_response()
+        result = self._make_response()
+        self.parser.update(result)
+        return result
 
 class Activities(API):
+    """
+    Besides the endpoints, it keeps an index of the activities by id and by
+    device side. The index is loaded once, kept up to date by the local
+    calls and reloaded after `ttl` seconds to pick up changes made in other
+    clients.
+    """
     _BASE_URL = '/activities'
 
-    def __init__(self, base_url, access_token):
-        super(Activities, self).__init__(base_url + self._BASE_URL, access_token)
+    def __init__(self, base_url, access_token, session=None, ttl=300):
+        super(Activities, self).__init__(base_url + self._BASE_URL, access_token, session)
+        self._ttl = ttl
+        self._index_lock = threading.RLock()
+        self._by_id = None
+        self._by_side = {}
+        self._loaded_at = 0
+
+    def _build_index(self, activities):
+        with self._index_lock:
+            self._by_id = {activity["id"]: activity for activity in activities}
+            self._by_side = {activity["deviceSide"]: activity for activity in activities
+                             if activity.get("deviceSide") is not None}
+            self._loaded_at = time.monotonic()
+
+    def _check_index(self):
+        with self._index_lock:
+            if self._by_id is None or time.monotonic() - self._loaded_at > self._ttl:
+                try:
+                    result = self.get()
+                except self._session.RequestException:
+                    # keep resolving flips with the stale index while offline
+                    if self._by_id is None:
+                        raise
+                else:
+                    if self._by_id is None and result and "status_code" in result:
+                        raise IOError('Loading the activities failed: %s' % result["message"])
+            return self._by_id is not None
+
+    def _index_activity(self, activity):
+        with self._index_lock:
+            if self._by_id is None or "id" not in activity:
+                return
+            previous = self._by_id.get(activity["id"])
+            if previous is not None and self._by_side.get(previous.get("deviceSide")) is previous:
+                del self._by_side[previous["deviceSide"]]
+            self._by_id[activity["id"]] = activity
+            if activity.get("deviceSide") is not None:
+                self._by_side[activity["deviceSide"]] = activity
+
+    def is_index_fresh(self):
+        """
+        True if lookups can be answered from the index without a request.
+        """
+        return self._by_id is not None and time.monotonic() - self._loaded_at <= self._ttl
+
+    def invalidate(self):
+        with self._index_lock:
+            self._by_id = None
+            self._by_side = {}
+        self._session.cache.invalidate(self._base_url)
 
     @check_token
     def get(self):
-        return self._make_response()
+        result = self._make_response()
+        if result and "activities" in result:
+            self._build_index(result["activities"])
+        return result
 
     @check_token
     def get_activity_id(self, id):
-        activities = self._make_response()["activities"]
-        for activity in activities:
-            if activity["id"] == id:
-                return activity
+        if self._check_index():
+            return self._by_id.get(id)
 
     @check_token
     def get_activitity_side(self, side):
-        activities = self._make_response()["activities"]
-        for activity in activities:
-            if activity["deviceSide"] == side:
-                return activity
+        if self._check_index():
+            return self._by_side.get(side)
 
     @check_token
     def post(self, json):
-        return self._make_response(method='post', json=json)
+        result = self._make_response(method='post', json_data=json)
+        if result and "status_code" not in result:
+            self._index_activity(result)
+        return result
 
     @check_token
     def patch(self, activity_id, json={}):
         route = '/%s' % str(activity_id)
-        return self._make_response(route, method='patch', json=json)
+        result = self._make_response(route, method='patch', json_data=json)
+        if result and "status_code" not in result:
+            self._index_activity(result)
+        return result
 
     @check_token
     def delete(self, activity_id):
         route = '/%s' % str(activity_id)
-        return self._make_response(route, method='delete', json=json)
+        result = self._make_response(route, method='delete')
+        if result is not False and "status_code" not in result:
+            with self._index_lock:
+                if self._by_id is not None:
+                    activity = self._by_id.pop(activity_id, None)
+                    if activity is not None and self._by_side.get(activity.get("deviceSide")) is activity:
+                        del self._by_side[activity["deviceSide"]]
+        return result
 
     @check_token
     def post_device_side(self, activity_id, device_side):
         route = '/%s/device-side/%s' % (str(activity_id), str(device_side))
-        return self._make_response(route, method='post')
+        result = self._make_response(route, method='post')
+        if result is not False and "status_code" not in result:
+            self._move_device_side(activity_id, device_side)
+        return result
 
     @check_token
     def delete_device_side(self, activity_id, device_side):
         route = '/%s/device-side/%s' % (str(activity_id), str(device_side))
-        return self._make_response(route, method='delete')
+        result = self._make_response(route, method='delete')
+        if result is not False and "status_code" not in result:
+            self._move_device_side(activity_id, None)
+        return result
+
+    def _move_device_side(self, activity_id, device_side):
+        with self._index_lock:
+            if self._by_id is None:
+                return
+            activity = self._by_id.get(activity_id)
+            if activity is None:
+                self.invalidate()
+                return
+            if self._by_side.get(activity.get("deviceSide")) is activity:
+                del self._by_side[activity["deviceSide"]]
+            if device_side is not None:
+                holder = self._by_side.get(device_side)
+                if holder is not None:
+                    holder["deviceSide"] = None
+                self._by_side[device_side] = activity
+            activity["deviceSide"] = device_side
 
     @check_token
     def get_tags_and_mentions(self, activity_id):
@@ -180,8 +480,8 @@ class Activities(API):
 class Devices(API):
     _BASE_URL = '/devices'
 
-    def __init__(self, base_url, access_token):
-        super(Devices, self).__init__(base_url + self._BASE_URL, access_token)
+    def __init__(self, base_url, access_token, session=None):
+        super(Devices, self).__init__(base_url + self._BASE_URL, access_token, session)
 
     @check_token
     def get(self):
@@ -218,43 +518,172 @@ class Devices(API):
         return self._make_response(route, method='delete')
 
 class Tracking(API):
+    """
+    Besides the requests, it keeps a model of the current tracking updated
+    from the responses to our own start/stop/patch, so that reading it
+    doesn't cost a request. It is checked against the server once it is
+    older than `sync_interval`, trackings started elsewhere show up then.
+    """
     _BASE_URL = '/tracking'
 
-    def __init__(self, base_url, access_token):
-        super(Tracking, self).__init__(base_url + self._BASE_URL, access_token)
+    def __init__(self, base_url, access_token, session=None, sync_interval=300):
+        super(Tracking, self).__init__(base_url + self._BASE_URL, access_token, session)
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._current = None
+        self._synced_at = None
+
+    def _set_current(self, tracking):
+        with self._lock:
+            self._current = tracking
+            self._synced_at = time.monotonic()
+
+    def current(self, max_age=None):
+        """
+        Returns the current tracking, None if nothing is tracked. The model
+        is used if it was updated within `max_age` seconds (`sync_interval`
+        by default), else the tracking is read from the server.
+        """
+        if max_age is None:
+            max_age = self.sync_interval
+        with self._lock:
+            if self._synced_at is not None and time.monotonic() - self._synced_at < max_age:
+                return self._current
+        result = self.get()
+        if "status_code" in result:
+            raise IOError('Reading the current tracking failed: %s' % result["message"])
+        return result["currentTracking"]
+
+    def invalidate(self):
+        with self._lock:
+            self._synced_at = None
 
     @check_token
     def get(self):
-        return self._make_response()
+        result = self._make_response()
+        if result and "currentTracking" in result:
+            self._set_current(result["currentTracking"])
+        return result
 
     @check_token
-    def post_start(self, activity_id):
+    def post_start(self, activity_id, started_at=None):
         route = '/%s/start' % str(activity_id)
-        datetime = get_current_time()
-        return self._make_response(route, method='post', json_data={'startedAt': datetime})
+        datetime = started_at or get_current_time()
+        result = self._make_response(route, method='post', json_data={'startedAt': datetime})
+        if result and "currentTracking" in result:
+            self._set_current(result["currentTracking"])
+        else:
+            self.invalidate()
+        return result
 
     @check_token
     def patch(self, activity_id, json={}):
         route = '/%s' % str(activity_id)
-        return self._make_response(route, method='patch', json_data=json)
+        result = self._make_response(route, method='patch', json_data=json)
+        if result and "currentTracking" in result:
+            self._set_current(result["currentTracking"])
+        elif result and "activity" in result:
+            self._set_current(result)
+        else:
+            self.invalidate()
+        return result
 
     @check_token
-    def post_stop(self, activity_id):
+    def post_stop(self, activity_id, stopped_at=None):
         route = '/%s/stop' % str(activity_id)
-        datetime = get_current_time()
-        return self._make_response(route, method='post', json_data={'stoppedAt': datetime})
+        datetime = stopped_at or get_current_time()
+        result = self._make_response(route, method='post', json_data={'stoppedAt': datetime})
+        if result and "status_code" not in result:
+            self._set_current(None)
+        else:
+            self.invalidate()
+        return result
+
+    def save_note(self, text, tags=[], mentions=[]):
+        """
+        Sets the note of the current tracking with a single PATCH.
+
+        Returns
+        -------
+        tracking, response : dict
+            The tracking the note was saved on and the API response, both
+            None if nothing is tracked
+        """
+        tracking = self.current()
+        if tracking is None:
+            return None, None
+        note = {"text": text, "tags": tags, "mentions": mentions}
+        return tracking, self.patch(tracking["activity"]["id"], {"note": note})
 
 class TimeEntries(API):
+    """
+    If a `TimeEntryStore` is set in `store`, the local post, patch and
+    delete calls are applied to it as well.
+    """
     _BASE_URL = '/time-entries'
 
-    def __init__(self, base_url, access_token):
-        super(TimeEntries, self).__init__(base_url + self._BASE_URL, access_token)
+    def __init__(self, base_url, access_token, session=None, store=None):
+        super(TimeEntries, self).__init__(base_url + self._BASE_URL, access_token, session)
+        self.store = store
 
     @check_token
     def get_in_range(self, stopped_after, started_before):
         route = '/%s/%s' % (str(stopped_after), str(started_before))
         return self._make_response(route)
 
+    def iter_range(self, stopped_after, started_before, window=timedelta(days=7), max_workers=4):
+        """
+        Streams the time entries of a long range. The range is split in
+        windows fetched at the same time, at most `max_workers` of them in
+        flight, and the entries are yielded window by window, sorted by
+        start, as soon as the windows arrive in order. Entries crossing the
+        edge of a window are only yielded once.
+
+        Parameters
+        ----------
+        stopped_after, started_before : string or datetime
+            The range, strings in the '2020-01-01T00:00:00.000' format
+        window : timedelta
+            Length of the range fetched by every request
+        max_workers : int
+            Maximum number of requests in flight
+        """
+        if self._access_token is None:
+            return
+        start = parse_time(stopped_after) if isinstance(stopped_after, str) else stopped_after
+        end = parse_time(started_before) if isinstance(started_before, str) else started_before
+        windows = []
+        while start < end:
+            windows.append((format_time(start), format_time(min(start + window, end))))
+            start += window
+
+        seen = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            windows = iter(windows)
+            for bounds in windows:
+                pending.append((bounds, executor.submit(self.get_in_range, *bounds)))
+                if len(pending) >= max_workers:
+                    break
+            while pending:
+                (window_start, _), future = pending.popleft()
+                for bounds in windows:
+                    pending.append((bounds, executor.submit(self.get_in_range, *bounds)))
+                    break
+                result = future.result()
+                if "status_code" in result:
+                    raise IOError('[%d] %s' % (result["status_code"], result["message"]))
+                # entries stopped before this window can't show up again
+                seen = {entry_id: stopped_at for entry_id, stopped_at in seen.items()
+                        if stopped_at >= window_start}
+                entries = sorted(result["timeEntries"],
+                                 key=lambda entry: entry["duration"]["startedAt"])
+                for entry in entries:
+                    if entry["id"] in seen:
+                        continue
+                    seen[entry["id"]] = entry["duration"]["stoppedAt"]
+                    yield entry
+
     @check_token
     def get_by_id(self, time_entry_id):
         route = '/%s' % str(time_entry_id)
@@ -262,14 +691,23 @@ class TimeEntries(API):
 
     @check_token
     def post(self, json):
-        return self._make_response(method='post', json=json)
+        result = self._make_response(method='post', json_data=json)
+        if self.store is not None and result and "status_code" not in result:
+            self.store.upsert([result])
+        return result
 
     @check_token
     def patch(self, time_entry_id, json={}):
         route = '/%s' % str(time_entry_id)
-        return self._make_response(route, method='patch', json=json)
+        result = self._make_response(route, method='patch', json_data=json)
+        if self.store is not None and result and "status_code" not in result:
+            self.store.upsert([result])
+        return result
 
     @check_token
     def delete(self, time_entry_id):
         route = '/%s' % str(time_entry_id)
-        return self._make_response(route, method='delete')
+        result = self._make_response(route, method='delete')
+        if self.store is not None and result is not False and "status_code" not in result:
+            self.store.delete(time_entry_id)
+        return result
@@ -0,0 +1,537 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+asyncio counterpart of classes/timeular.py, running on aiohttp. aiohttp is
+an optional dependency, only needed by this module:
+
+    pip install aiohttp
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+import aiohttp
+
+from .timeular import TokenManager, get_current_time
+from .tags import TagParser
+
+import logging
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.StreamHandler())
+_log.setLevel(logging.NOTSET)
+
+
+def check_token(f):
+    @wraps(f)
+    async def wrapper(self, *args, **kwargs):
+        if self._access_token == None:
+            return False
+        return await f(self, *args, **kwargs)
+
+    return wrapper
+
+class AsyncHTTPSession(object):
+    """
+    Pooled keep-alive aiohttp session shared by the async API clients.
+    It has to be created and used from inside the event loop.
+    """
+    def __init__(self, pool_size=16, timeout=10, keepalive_timeout=60, health_window=10):
+        """
+        Parameters
+        ----------
+        pool_size : int
+            Maximum number of simultaneous connections
+        timeout : float
+            Total timeout in seconds for every request
+        keepalive_timeout : float
+            Seconds an idle connection is kept open
+        health_window : int
+            Number of recent request outcomes used by `is_healthy`
+        """
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size,
+                                           keepalive_timeout=keepalive_timeout),
+            timeout=aiohttp.ClientTimeout(total=timeout))
+        self._outcomes = deque(maxlen=health_window)
+
+    async def request(self, method, url, json_data=None, headers=None):
+        """
+        Returns a (status_code, text) tuple, the body is read before the
+        connection goes back to the pool.
+        """
+        try:
+            async with self._session.request(method, url, json=json_data,
+                                             headers=headers) as response:
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self._outcomes.append(False)
+            raise
+        self._outcomes.append(response.status < 500)
+        return response.status, text
+
+    def is_healthy(self):
+        if not self._outcomes:
+            return False
+        return self._outcomes[-1] and \
+            sum(self._outcomes) * 2 > len(self._outcomes)
+
+    async def close(self):
+        await self._session.close()
+
+class AsyncAPI(object):
+    _METHODS = ['get', 'post', 'patch', 'delete']
+    _CLASS_STATUS_CODES = (200, 226)
+
+    _access_token = None
+    _base_url = None
+    _session = None
+
+    def __init__(self, base_url, access_token=None, session=None):
+        self._base_url = base_url
+        self._access_token = access_token
+        self._session = session
+
+    async def _make_response(self, route='', method='get', json_data={}, need_auth=True, headers={}):
+        if method not in self._METHODS:
+            _log.info('[%s] is not allowed' % method)
+            return False
+        url = self._base_url + route
+
+        headers = dict(headers)
+        if need_auth:
+            headers['Authorization'] = 'Bearer ' + self._access_token
+
+        status_code, text = await self._session.request(method, url, json_data=json_data,
+                                                        headers=headers)
+
+        if status_code < self._CLASS_STATUS_CODES[0] or \
+            status_code > self._CLASS_STATUS_CODES[1]:
+            _log.info('code error: %d' % status_code)
+            _log.info('[%s]: %s' % (url, text))
+            return {"status_code": status_code, "message": text}
+
+        return json.loads(text) if text else {}
+
+class AsyncTimeular(AsyncAPI):
+    """
+    Use `AsyncTimeular.create` inside a running event loop, the constructor
+    alone doesn't sign in.
+    """
+    activities = None
+    devices = None
+    tracking = None
+    time_entries = None
+    tags_and_mentions = None
+
+    _api_key = None
+    _api_secret = None
+
+    def __init__(self, api_key='', api_secret='', base_url='https://api.timeular.com/api/v2',
+                 session=None):
+        super(AsyncTimeular, self).__init__(base_url, session=session)
+        self._api_key = api_key
+        self._api_secret = api_secret
+        self._refresh_task = None
+        self.activities = AsyncActivities(base_url, None, self._session)
+        self.devices = AsyncDevices(base_url, None, self._session)
+        self.tracking = AsyncTracking(base_url, None, self._session)
+        self.time_entries = AsyncTimeEntries(base_url, None, self._session)
+        self.tags_and_mentions = AsyncTagMentions(base_url, None, self._session)
+
+    @classmethod
+    async def create(cls, api_key='', api_secret='', base_url='https://api.timeular.com/api/v2',
+                     pool_size=16, timeout=10):
+        client = cls(api_key, api_secret, base_url,
+                     session=AsyncHTTPSession(pool_size=pool_size, timeout=timeout))
+        if not await client.get_access_token():
+            await client.close()
+            raise ValueError('Check base_url and the route to get your access token')
+        client._refresh_task = asyncio.ensure_future(client._refresh_token_loop())
+        return client
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        await self._session.close()
+
+    def set_api_key(self, api_key):
+        self._api_key = api_key
+
+    def set_api_secret(self, api_secret):
+        self._api_secret = api_secret
+
+    def set_access_token(self, access_token):
+        self._access_token = access_token
+        for client in (self.activities, self.devices, self.tracking,
+                       self.time_entries, self.tags_and_mentions):
+            client._access_token = access_token
+
+    async def get_access_token(self):
+        result = await self._make_response('/developer/sign-in',
+                                           method="post",
+                                           json_data={'apiKey': self._api_key,
+                                                      'apiSecret': self._api_secret},
+                                           need_auth=False)
+        if "status_code" in result:
+            return False
+        self.set_access_token(result['token'])
+        return result
+
+    async def _refresh_token_loop(self, refresh_margin=300, default_lifetime=3600, retry_interval=30):
+        delay = None
+        while True:
+            if delay is None:
+                expires_at = TokenManager.get_token_expiry(self._access_token) or \
+                    time.time() + default_lifetime
+                delay = expires_at - refresh_margin - time.time()
+            await asyncio.sleep(max(delay, 0))
+            try:
+                delay = None if await self.get_access_token() else retry_interval
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                _log.info('token refresh failed: %s' % e)
+                delay = retry_interval
+
+    def is_connected(self):
+        return self._session.is_healthy()
+
+    @check_token
+    async def get_profile(self):
+        return await self._make_response('/user/profile')
+
+    @check_token
+    async def get_integrations(self):
+        return await self._make_response('/integrations')
+
+    @check_token
+    async def get_report(self, start_timestamp, stop_timestamp, timezone='Europe/Paris'):
+        route = '/report/%s/%s?timezone=%s' % (str(start_timestamp), str(stop_timestamp), str(timezone))
+        return await self._make_response(route)
+
+
+class AsyncTagMentions(AsyncAPI):
+    """
+    Every `get` refreshes `parser`, as in `TagMentions`.
+    """
+    _BASE_URL = '/tags-and-mentions'
+
+    def __init__(self, base_url, access_token, session=None):
+        super(AsyncTagMentions, self).__init__(base_url + self._BASE_URL, access_token, session)
+        self.parser = TagParser()
+
+    @check_token
+    async def get(self):
+        result = await self._make_response()
+        self.parser.update(result)
+        return result
+
+class AsyncActivities(AsyncAPI):
+    """
+    Keeps the same id / device side index as `Activities`. Writes drop the
+    index, the next lookup reloads it.
+    """
+    _BASE_URL = '/activities'
+
+    def __init__(self, base_url, access_token, session=None, ttl=300):
+        super(AsyncActivities, self).__init__(base_url + self._BASE_URL, access_token, session)
+        self._ttl = ttl
+        self._by_id = None
+        self._by_side = {}
+        self._loaded_at = 0
+
+    async def _check_index(self):
+        if self._by_id is None or time.monotonic() - self._loaded_at > self._ttl:
+            try:
+                result = await self.get()
+            except aiohttp.ClientError:
+                # keep resolving flips with the stale index while offline
+                if self._by_id is None:
+                    raise
+            else:
+                if self._by_id is None and result and "status_code" in result:
+                    raise IOError('Loading the activities failed: %s' % result["message"])
+        return self._by_id is not None
+
+    def is_index_fresh(self):
+        """
+        True if lookups can be answered from the index without a request.
+        """
+        return self._by_id is not None and time.monotonic() - self._loaded_at <= self._ttl
+
+    def invalidate(self):
+        self._by_id = None
+        self._by_side = {}
+
+    def _invalidate_on_success(self, result):
+        if result is not False and "status_code" not in result:
+            self.invalidate()
+        return result
+
+    @check_token
+    async def get(self):
+        result = await self._make_response()
+        if result and "activities" in result:
+            self._by_id = {activity["id"]: activity for activity in result["activities"]}
+            self._by_side = {activity["deviceSide"]: activity for activity in result["activities"]
+                             if activity.get("deviceSide") is not None}
+            self._loaded_at = time.monotonic()
+        return result
+
+    @check_token
+    async def get_activity_id(self, id):
+        if await self._check_index():
+            return self._by_id.get(id)
+
+    @check_token
+    async def get_activitity_side(self, side):
+        if await self._check_index():
+            return self._by_side.get(side)
+
+    @check_token
+    async def post(self, json):
+        return self._invalidate_on_success(
+            await self._make_response(method='post', json_data=json))
+
+    @check_token
+    async def patch(self, activity_id, json={}):
+        route = '/%s' % str(activity_id)
+        return self._invalidate_on_success(
+            await self._make_response(route, method='patch', json_data=json))
+
+    @check_token
+    async def delete(self, activity_id):
+        route = '/%s' % str(activity_id)
+        return self._invalidate_on_success(
+            await self._make_response(route, method='delete'))
+
+    @check_token
+    async def post_device_side(self, activity_id, device_side):
+        route = '/%s/device-side/%s' % (str(activity_id), str(device_side))
+        return self._invalidate_on_success(
+            await self._make_response(route, method='post'))
+
+    @check_token
+    async def delete_device_side(self, activity_id, device_side):
+        route = '/%s/device-side/%s' % (str(activity_id), str(device_side))
+        return self._invalidate_on_success(
+            await self._make_response(route, method='delete'))
+
+    @check_token
+    async def get_tags_and_mentions(self, activity_id):
+        route = '/%s' % (str(activity_id))
+        return await self._make_response(route)
+
+class AsyncDevices(AsyncAPI):
+    _BASE_URL = '/devices'
+
+    def __init__(self, base_url, access_token, session=None):
+        super(AsyncDevices, self).__init__(base_url + self._BASE_URL, access_token, session)
+
+    @check_token
+    async def get(self):
+        return await self._make_response()
+
+    @check_token
+    async def patch(self, device_serial, json={}):
+        route = '/%s' % str(device_serial)
+        return await self._make_response(route, method='patch', json_data=json)
+
+    @check_token
+    async def delete(self, device_serial):
+        route = '/%s' % str(device_serial)
+        return await self._make_response(route, method='delete')
+
+    @check_token
+    async def post_disabled(self, device_serial):
+        route = '/%s/disabled' % str(device_serial)
+        return await self._make_response(route, method='post')
+
+    @check_token
+    async def delete_disabled(self, device_serial):
+        route = '/%s/disabled' % str(device_serial)
+        return await self._make_response(route, method='delete')
+
+    @check_token
+    async def post_active(self, device_serial):
+        route = '/%s/active' % str(device_serial)
+        return await self._make_response(route, method='post')
+
+    @check_token
+    async def delete_active(self, device_serial):
+        route = '/%s/active' % str(device_serial)
+        return await self._make_response(route, method='delete')
+
+class AsyncTracking(AsyncAPI):
+    """
+    Keeps the same current-tracking model as `Tracking`, updated from the
+    responses to our own start/stop/patch and re-read from the server
+    once it is older than `sync_interval`.
+    """
+    _BASE_URL = '/tracking'
+
+    def __init__(self, base_url, access_token, session=None, sync_interval=300):
+        super(AsyncTracking, self).__init__(base_url + self._BASE_URL, access_token, session)
+        self.sync_interval = sync_interval
+        self._current = None
+        self._synced_at = None
+
+    def _set_current(self, tracking):
+        self._current = tracking
+        self._synced_at = time.monotonic()
+
+    async def current(self, max_age=None):
+        """
+        Returns the current tracking, None if nothing is tracked, see
+        `Tracking.current`.
+        """
+        if max_age is None:
+            max_age = self.sync_interval
+        if self._synced_at is not None and time.monotonic() - self._synced_at < max_age:
+            return self._current
+        result = await self.get()
+        if "status_code" in result:
+            raise IOError('Reading the current tracking failed: %s' % result["message"])
+        return result["currentTracking"]
+
+    def invalidate(self):
+        self._synced_at = None
+
+    @check_token
+    async def get(self):
+        result = await self._make_response()
+        if result and "currentTracking" in result:
+            self._set_current(result["currentTracking"])
+        return result
+
+    @check_token
+    async def post_start(self, activity_id, started_at=None):
+        route = '/%s/start' % str(activity_id)
+        result = await self._make_response(route, method='post',
+                                           json_data={'startedAt': started_at or get_current_time()})
+        if result and "currentTracking" in result:
+            self._set_current(result["currentTracking"])
+        else:
+            self.invalidate()
+        return result
+
+    @check_token
+    async def patch(self, activity_id, json={}):
+        route = '/%s' % str(activity_id)
+        result = await self._make_response(route, method='patch', json_data=json)
+        if result and "currentTracking" in result:
+            self._set_current(result["currentTracking"])
+        elif result and "activity" in result:
+            self._set_current(result)
+        else:
+            self.invalidate()
+        return result
+
+    @check_token
+    async def post_stop(self, activity_id, stopped_at=None):
+        route = '/%s/stop' % str(activity_id)
+        result = await self._make_response(route, method='post',
+                                           json_data={'stoppedAt': stopped_at or get_current_time()})
+        if result and "status_code" not in result:
+            self._set_current(None)
+        else:
+            self.invalidate()
+        return result
+
+    async def save_note(self, text, tags=[], mentions=[]):
+        """
+        Sets the note of the current tracking with a single PATCH, see
+        `Tracking.save_note`.
+        """
+        tracking = await self.current()
+        if tracking is None:
+            return None, None
+        note = {"text": text, "tags": tags, "mentions": mentions}
+        return tracking, await self.patch(tracking["activity"]["id"], {"note": note})
+
+class AsyncTimeEntries(AsyncAPI):
+    _BASE_URL = '/time-entries'
+
+    def __init__(self, base_url, access_token, session=None):
+        super(AsyncTimeEntries, self).__init__(base_url + self._BASE_URL, access_token, session)
+
+    @check_token
+    async def get_in_range(self, stopped_after, started_before):
+        route = '/%s/%s' % (str(stopped_after), str(started_before))
+        return await self._make_response(route)
+
+    @check_token
+    async def get_by_id(self, time_entry_id):
+        route = '/%s' % str(time_entry_id)
+        return await self._make_response(route)
+
+    @check_token
+    async def post(self, json):
+        return await self._make_response(method='post', json_data=json)
+
+    @check_token
+    async def patch(self, time_entry_id, json={}):
+        route = '/%s' % str(time_entry_id)
+        return await self._make_response(route, method='patch', json_data=json)
+
+    @check_token
+    async def delete(self, time_entry_id):
+        route = '/%s' % str(time_entry_id)
+        return await self._make_response(route, method='delete')
+
+
+class _SyncProxy(object):
+    """
+    Exposes the coroutine methods of an async client as blocking calls
+    executed on the facade's event loop.
+    """
+    def __init__(self, target, loop, timeout):
+        self._target = target
+        self._loop = loop
+        self._timeout = timeout
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('_target', '_loop', '_timeout'):
+            raise AttributeError(name)
+        attr = getattr(self._target, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        @wraps(attr)
+        def call(*args, **kwargs):
+            future = asyncio.run_coroutine_threadsafe(attr(*args, **kwargs), self._loop)
+            return future.result(self._timeout)
+        return call
+
+class TimeularSync(_SyncProxy):
+    """
+    Blocking facade over `AsyncTimeular` with the same interface as
+    `Timeular`, so the GUI code can use the async client unchanged. Keep
+    the async classes in step with classes/timeular.py for this to hold. The
+    event loop runs in a daemon thread and can be shared with other
+    coroutines through `loop`.
+    """
+    def __init__(self, api_key='', api_secret='', base_url='https://api.timeular.com/api/v2',
+                 pool_size=16, timeout=10):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        try:
+            client = asyncio.run_coroutine_threadsafe(
+                AsyncTimeular.create(api_key, api_secret, base_url, pool_size, timeout),
+                self.loop).result()
+        except Exception:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            raise
+        super(TimeularSync, self).__init__(client, self.loop, timeout)
+        self.activities = _SyncProxy(client.activities, self.loop, timeout)
+        self.devices = _SyncProxy(client.devices, self.loop, timeout)
+        self.tracking = _SyncProxy(client.tracking, self.loop, timeout)
+        self.time_entries = _SyncProxy(client.time_entries, self.loop, timeout)
+        self.tags_and_mentions = _SyncProxy(client.tags_and_mentions, self.loop, timeout)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._target.close(), self.loop).result(self._timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
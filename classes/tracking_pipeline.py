@@ -0,0 +1,167 @@
+from .timeular import get_current_time
+
+
+class TrackingPipeline():
+    """
+    Turns the sides of one tracker into activity switches written to the
+    tracking journal, the `JournalReplayer` sends them to the API. It holds
+    the tracking state and has no GUI dependency, the GUI and the headless
+    daemon drive it the same way.
+    """
+    def __init__(self, journal, client=None, merge_window=5, side_activities=None):
+        """
+        Parameters
+        ----------
+        journal : TrackingJournal
+            Where the switches are written
+        client : Timeular
+            API client used to resolve the activities, it can be set later
+        merge_window : float
+            Switches closer than this are merged, see `TrackingJournal.append_switch`
+        side_activities : dict, optional
+            Device side -> activity id overriding the sides set in the account
+        """
+        self.journal = journal
+        self.client = client
+        self.merge_window = merge_window
+        self.side_activities = side_activities or {}
+        self.octahedron_side = None
+        self.activity_id = None
+        self.activity_name = None
+        self.start_time = None
+        # False while the activity of a journaled side isn't known yet
+        self.synced = True
+
+    def can_resolve_locally(self, tracking=None):
+        """
+        True if `resolve` is answered without a request.
+        """
+        if tracking is not None and "name" in tracking["activity"]:
+            return True
+        return self.client.activities.is_index_fresh()
+
+    def resolve(self, octahedron_side=None, tracking=None):
+        """
+        Returns the activity of a side or of a tracking read from the API,
+        None if the side has no activity.
+        """
+        activities = self.client.activities
+        if tracking is not None:
+            if "name" in tracking["activity"]:
+                # the tracking embeds its activity, no need for the list
+                return tracking["activity"]
+            return activities.get_activity_id(tracking["activity"]["id"])
+        if octahedron_side in self.side_activities:
+            return activities.get_activity_id(self.side_activities[octahedron_side])
+        return activities.get_activitity_side(octahedron_side)
+
+    def apply(self, activity, octahedron_side=None, tracking=None, timestamp=None):
+        """
+        Makes `activity` the tracked one. A tracking read from the API is
+        only adopted, anything else is journaled as a switch.
+
+        Returns
+        -------
+        activity_name : string
+            The text describing the new state
+        """
+        if timestamp is None:
+            timestamp = get_current_time()
+        if activity:
+            activity_name = activity["name"]
+            activity_id = activity["id"]
+        else:
+            activity_id = None
+            if self.octahedron_side is not None:
+                activity_name = "Paused!"
+            else:
+                activity_name = "Not defined!"
+
+        if tracking is None:
+            if self.synced:
+                self.journal.append_switch(self.activity_id, activity_id, timestamp,
+                                           self.merge_window)
+            else:
+                # the activity running before is unknown, the replay stops it
+                self.journal.append('switch', activity_id or '', timestamp)
+
+        self.octahedron_side = octahedron_side
+        self.activity_id = activity_id
+        self.activity_name = activity_name
+        self.start_time = tracking["startedAt"] if tracking is not None else timestamp
+        self.synced = True
+        return activity_name
+
+    def defer(self, octahedron_side, timestamp=None):
+        """
+        Journals a side which can't be resolved now, without client or
+        activity index, e.g. while the API is unreachable. The
+        `JournalReplayer` resolves it when it is sent.
+
+        Returns
+        -------
+        activity_name : string
+            The text describing the new state
+        """
+        if timestamp is None:
+            timestamp = get_current_time()
+        if octahedron_side in self.side_activities:
+            activity_id = self.side_activities[octahedron_side]
+            self.journal.append('switch', activity_id, timestamp)
+            self.synced = True
+        else:
+            activity_id = None
+            self.journal.append('side', octahedron_side, timestamp)
+            self.synced = False
+        self.octahedron_side = octahedron_side
+        self.activity_id = activity_id
+        self.activity_name = "Side %s (offline)" % octahedron_side
+        self.start_time = timestamp
+        return self.activity_name
+
+    def change_side(self, octahedron_side, timestamp=None):
+        """
+        Blocking `resolve` + `apply` of a settled side.
+        """
+        if octahedron_side == self.octahedron_side:
+            return self.activity_name
+        if self.client is None:
+            return self.defer(octahedron_side, timestamp)
+        try:
+            activity = self.resolve(octahedron_side)
+        except Exception:
+            return self.defer(octahedron_side, timestamp)
+        return self.apply(activity, octahedron_side, timestamp=timestamp)
+
+    def rejected(self, event, message):
+        """
+        Resets the state if the API rejected the start of the tracked
+        activity. Returns True if it did.
+        """
+        if not (message and "status_code" in message):
+            return False
+        if (event.action in ('start', 'switch') and str(self.activity_id) == event.activity_id) \
+            or (event.action == 'side' and not self.synced
+                and str(self.octahedron_side) == event.activity_id):
+            self.activity_id = None
+            self.activity_name = None
+            self.start_time = None
+            self.synced = True
+            return True
+        return False
+
+    def replayed(self, event, response):
+        """
+        Adopts the activity a journaled side was resolved to, once it was
+        the last pending entry. Returns the new text describing the state,
+        None if it didn't change.
+        """
+        if event.action != 'side' or self.synced or \
+            str(self.octahedron_side) != event.activity_id or self.journal.pending_count():
+            return None
+        tracking = (response or {}).get("currentTracking")
+        if tracking is not None:
+            return self.apply(tracking["activity"], self.octahedron_side, tracking)
+        self.activity_name = "Paused!"
+        self.synced = True
+        return self.activity_name
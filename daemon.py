@@ -0,0 +1,31 @@
+"""
+Headless tracker service, without Tk. It reads the same data.json as the
+GUI and logs one JSON object per line on stdout, or to --log-file:
+
+    python3 daemon.py --config data.json --journal-dir /var/lib/timeular
+"""
+import argparse
+import json
+import signal
+
+from classes.headless import HeadlessTracker, setup_logging
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Timeular ZEI tracker service')
+    parser.add_argument('--config', default='data.json',
+                        help='settings file (default: data.json)')
+    parser.add_argument('--journal-dir', default='.',
+                        help='directory of the tracking journals')
+    parser.add_argument('--log-format', choices=('json', 'text'), default='json')
+    parser.add_argument('--log-file', default=None,
+                        help='append the logs to this file instead of stdout')
+    args = parser.parse_args()
+
+    setup_logging(args.log_format, log_file=args.log_file)
+    with open(args.config) as json_file:
+        data = json.load(json_file)
+
+    tracker = HeadlessTracker(data, journal_dir=args.journal_dir)
+    signal.signal(signal.SIGTERM, lambda signum, frame: tracker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: tracker.stop())
+    tracker.run()
@@ -1,10 +1,24 @@
 import tkinter as tk
 import os
+from classes import startup
 from classes.thread_client import ThreadedClient
 
+def first_paint(event):
+    # the toplevel also receives the <Map> of every child widget
+    if event.widget is not master:
+        return
+    master.unbind('<Map>', paint_binding)
+    startup.mark('first_paint')
+    if os.environ.get('TIMEULAR_STARTUP_BENCH') == 'paint':
+        master.after_idle(master.destroy)
+    elif os.environ.get('TIMEULAR_STARTUP_BENCH') == 'connect':
+        client.gui.create_connect_to_window()
+
 if __name__ == '__main__':
     master = tk.Tk()
     master.wm_title("Timeular")
     master.iconphoto(True, tk.PhotoImage(file=os.path.join(os.sys.path[0], "icon.png")))
     client = ThreadedClient(master)
+    if startup.ENABLED:
+        paint_binding = master.bind('<Map>', first_paint, add='+')
     master.mainloop()
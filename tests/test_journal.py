@@ -0,0 +1,88 @@
+"""
+Quick-switch merging of the tracking journal while the API is reachable.
+
+    python -m pytest tests/test_journal.py
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from classes.journal import TrackingJournal, JournalReplayer
+from classes.tracking_pipeline import TrackingPipeline
+from classes.timeular import get_current_time
+
+
+class FakeTracking():
+    """
+    Records the starts and stops, every one of them is accepted.
+    """
+    def __init__(self):
+        self.calls = []
+        self.sent = threading.Event()
+
+    def post_start(self, activity_id, started_at=None):
+        self.calls.append(('start', activity_id, started_at))
+        self.sent.set()
+        return {"currentTracking": {"activity": {"id": activity_id}, "startedAt": started_at}}
+
+    def post_stop(self, activity_id, stopped_at=None):
+        self.calls.append(('stop', activity_id, stopped_at))
+        self.sent.set()
+        return {"createdTimeEntry": {}}
+
+
+class FakeClient():
+    def __init__(self):
+        self.tracking = FakeTracking()
+
+
+class JournalReplayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = TrackingJournal(os.path.join(self.directory, 'journal.db'))
+        self.client = FakeClient()
+        self.pipeline = TrackingPipeline(self.journal, merge_window=0.5)
+        self.replayer = JournalReplayer(self.journal, self.client, backoff=(0.01, 0.1),
+                                        merge_window=0.5)
+        self.replayer.start()
+
+    def tearDown(self):
+        self.replayer.stop()
+        self.replayer.join(1)
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def flip(self, activity_id):
+        self.pipeline.apply({"id": activity_id, "name": activity_id}, timestamp=get_current_time())
+
+    def test_quick_switches_are_merged_online(self):
+        first = get_current_time()
+        self.pipeline.apply({"id": "a", "name": "a"}, timestamp=first)
+        time.sleep(0.1)
+        self.flip("b")
+        time.sleep(0.1)
+        self.flip("c")
+        self.assertTrue(self.client.tracking.sent.wait(2))
+        time.sleep(0.1)
+        # a single start of the last activity, at the time of the first flip
+        self.assertEqual(self.client.tracking.calls, [('start', 'c', first)])
+        self.assertEqual(self.journal.pending_count(), 0)
+
+    def test_settled_start_is_sent(self):
+        self.flip("a")
+        self.assertTrue(self.client.tracking.sent.wait(2))
+        self.client.tracking.sent.clear()
+        time.sleep(0.6)
+        self.flip("b")
+        self.assertTrue(self.client.tracking.sent.wait(2))
+        time.sleep(0.7)
+        self.assertEqual([call[:2] for call in self.client.tracking.calls],
+                         [('start', 'a'), ('stop', 'a'), ('start', 'b')])
+
+
+if __name__ == '__main__':
+    unittest.main()
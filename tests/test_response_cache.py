@@ -0,0 +1,119 @@
+"""
+Response cache of `API._make_response` against a local stand-in server.
+
+    python -m pytest tests/test_response_cache.py
+"""
+import http.server
+import json
+import threading
+import unittest
+
+from classes.timeular import API, HTTPSession
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers every GET with a JSON body and the ETag of its path, or a 304
+    if the request carries that ETag. Every request is recorded.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('ETag', '"%s"' % self.path)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _record(self):
+        # requests sends the default json_data={} as a body, even on GET
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((self.command, self.path, self.headers.get('If-None-Match')))
+
+    def do_GET(self):
+        self._record()
+        if self.headers.get('If-None-Match') == '"%s"' % self.path:
+            self._reply(304)
+        else:
+            self._reply(200, json.dumps({'path': self.path}).encode('utf-8'))
+
+    def do_POST(self):
+        self._record()
+        self._reply(200, b'{}')
+
+
+class Resource(API):
+    _BASE_URL = '/activities'
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.server.requests = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests.clear()
+        self.session = HTTPSession(cache_size=2)
+        self.session.cache.policy = {'/activities': 60}
+        base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.api = Resource(base_url + Resource._BASE_URL, 'token', self.session)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_fresh_hit_sends_no_request(self):
+        first = self.api._make_response('/a')
+        second = self.api._make_response('/a')
+        self.assertIs(first, second)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.session.cache.hits, 1)
+
+    def test_stale_entry_is_revalidated(self):
+        self.session.cache.policy = {'/activities': 0}
+        first = self.api._make_response('/a')
+        second = self.api._make_response('/a')
+        self.assertIs(first, second)
+        self.assertEqual(self.server.requests,
+                         [('GET', '/activities/a', None),
+                          ('GET', '/activities/a', '"/activities/a"')])
+        self.assertEqual(self.session.cache.revalidated, 1)
+
+    def test_least_recently_used_is_evicted(self):
+        self.api._make_response('/a')
+        self.api._make_response('/b')
+        self.api._make_response('/a')
+        self.api._make_response('/c')
+        self.assertEqual(len(self.session.cache), 2)
+        self.server.requests.clear()
+        self.api._make_response('/a')
+        self.api._make_response('/b')
+        self.assertEqual([path for _, path, _ in self.server.requests], ['/activities/b'])
+
+    def test_write_invalidates_cached_reads(self):
+        self.api._make_response('/a')
+        self.api._make_response('/a/start', method='post')
+        self.api._make_response('/a')
+        self.assertEqual([(method, path) for method, path, _ in self.server.requests],
+                         [('GET', '/activities/a'), ('POST', '/activities/a/start'),
+                          ('GET', '/activities/a')])
+
+    def test_uncached_resource(self):
+        self.session.cache.policy = {}
+        self.api._make_response('/a')
+        self.api._make_response('/a')
+        self.assertEqual([etag for _, _, etag in self.server.requests], [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()